@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# Python 3
+import os
+import time
+import pickle  # nosec
+import sqlite3
+import hashlib
+import threading
+import collections
+
+from httpcache import writeAtomic
+
+__all__ = ['Cache', 'LRU', 'MemoryBackend', 'DiskBackend', 'SQLiteBackend', 'getCache', 'getLRU',
+           'setBackend', 'backendFromEnvironment', 'allStats', 'estimatedSize', 'environmentVariable']
+
+# e.g. MENSAHD_CACHE=sqlite:/tmp/mensahd.sqlite to share the cache between gunicorn workers
+environmentVariable = 'MENSAHD_CACHE'
+# Limit of the estimated size of the memory backend, e.g. for the bodies of stored responses
+defaultMemoryBytes = 64 * 1024 * 1024
+# Expired entries are removed from disk and SQLite when the backend is first used and then at this interval
+purgeSeconds = 60 * 60
+
+
+def estimatedSize(value):
+    """Rough size in bytes: the length of all strings and bytes in value"""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(estimatedSize(item) for item in value)
+    if isinstance(value, dict):
+        return sum(estimatedSize(key) + estimatedSize(item) for key, item in value.items())
+    return 8
+
+
+class _Purging:
+    """Calls self.purge(now) on the first set() and then every purgeSeconds"""
+    nextPurge = 0
+
+    def _purgeDue(self):
+        now = time.time()
+        if now < self.nextPurge:
+            return
+        self.nextPurge = now + purgeSeconds
+        self.purge(now)
+
+
+class LRU:
+    """Objects of this process, bounded by the number of entries and by their
+    estimated size in bytes. The least recently used entries are evicted first"""
+
+    def __init__(self, maxEntries=1024, maxBytes=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > self.maxEntries or (
+                    self.maxBytes is not None and self.bytes > self.maxBytes and len(self.entries) > 1):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.bytes,
+                    'hitRate': round(self.hits / lookups, 3) if lookups else None}
+
+
+class MemoryBackend:
+    """Least recently used entries of this process, bounded by the number of entries
+    and their estimated size"""
+
+    def __init__(self, maxEntries=1024, maxBytes=defaultMemoryBytes):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = LRU(maxEntries, maxBytes)
+
+    def get(self, namespace, key):
+        return self.entries.get((namespace, key))
+
+    def set(self, namespace, key, value, storedAt, expiresAt):
+        self.entries.set((namespace, key), (value, storedAt, expiresAt), size=estimatedSize(value))
+
+    def delete(self, namespace, key):
+        self.entries.delete((namespace, key))
+
+
+class DiskBackend(_Purging):
+    """One pickle file per entry in a directory. The modification time of an entry
+    with a time to live is set to its expiry, so expired files are found without reading all files"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _filename(self, namespace, key):
+        name = hashlib.sha256(f'{namespace}\0{key}'.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.pickle')
+
+    def get(self, namespace, key):
+        try:
+            with open(self._filename(namespace, key), 'rb') as f:
+                storedNamespace, storedKey, *entry = pickle.load(f)  # nosec
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if (storedNamespace, storedKey) != (namespace, key):
+            return None
+        return tuple(entry)
+
+    def set(self, namespace, key, value, storedAt, expiresAt):
+        os.makedirs(self.directory, exist_ok=True)
+        self._purgeDue()
+        filename = self._filename(namespace, key)
+        writeAtomic(filename, pickle.dumps((namespace, key, value, storedAt, expiresAt)))
+        if expiresAt is not None:
+            os.utime(filename, (expiresAt, expiresAt))
+
+    def purge(self, now):
+        """Remove the entries that expired before now"""
+        with os.scandir(self.directory) as files:
+            for file in files:
+                if file.name.endswith('.pickle') and file.stat().st_mtime < now:
+                    try:
+                        with open(file.path, 'rb') as f:
+                            expiresAt = pickle.load(f)[4]  # nosec
+                    except (OSError, EOFError, pickle.UnpicklingError, IndexError):
+                        continue
+                    if expiresAt is not None and expiresAt < now:
+                        self._remove(file.path)
+
+    def delete(self, namespace, key):
+        self._remove(self._filename(namespace, key))
+
+    @staticmethod
+    def _remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteBackend(_Purging):
+    """A SQLite file that several processes can use at the same time"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = sqlite3.connect(self.filename, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value BLOB, '
+                               'storedAt REAL, expiresAt REAL, PRIMARY KEY (namespace, key))')
+        return connection
+
+    def get(self, namespace, key):
+        row = self._connection().execute('SELECT value, storedAt, expiresAt FROM cache WHERE namespace=? AND key=?',
+                                         (namespace, key)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1], row[2]  # nosec
+
+    def set(self, namespace, key, value, storedAt, expiresAt):
+        self._purgeDue()
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                               (namespace, key, pickle.dumps(value), storedAt, expiresAt))
+
+    def purge(self, now):
+        """Remove the entries that expired before now"""
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE expiresAt < ?', (now, ))
+
+    def delete(self, namespace, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE namespace=? AND key=?', (namespace, key))
+
+
+class Cache:
+    """Values with a time to live, stored in a backend. Keys are strings, values must be
+    picklable for the disk and SQLite backends. Counts hits, misses and stores"""
+
+    def __init__(self, name, ttl=None, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _backend(self):
+        return self.backend or defaultBackend()
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def getWithAge(self, key, maxAge=None):
+        """Returns (value, age in seconds) or None. Expired entries are returned too, if they
+        are younger than maxAge and the backend has not purged them yet"""
+        entry = self._backend().get(self.name, key)
+        now = time.time()
+        if entry is not None:
+            value, storedAt, expiresAt = entry
+            if maxAge is None:
+                fresh = expiresAt is None or now < expiresAt
+            else:
+                fresh = now - storedAt <= maxAge
+            if fresh:
+                self._count('hits')
+                return value, now - storedAt
+        self._count('misses')
+        return None
+
+    def get(self, key, default=None):
+        entry = self.getWithAge(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        self._backend().set(self.name, key, value, now, None if ttl is None else now + ttl)
+        self._count('stores')
+
+    def delete(self, key):
+        self._backend().delete(self.name, key)
+
+    def getOrSet(self, key, compute, ttl=None):
+        """Return the cached value or store and return compute()"""
+        entry = self.getWithAge(key)
+        if entry is not None:
+            return entry[0]
+        value = compute()
+        self.set(key, value, ttl)
+        return value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores,
+                    'hitRate': round(self.hits / lookups, 3) if lookups else None}
+
+
+caches = {}
+cachesLock = threading.Lock()
+backend = None
+
+
+def backendFromEnvironment():
+    """Backend configured with MENSAHD_CACHE=memory, disk:DIRECTORY or sqlite:FILE"""
+    value = os.getenv(environmentVariable) or 'memory'
+    kind, _, location = value.partition(':')
+    if kind == 'memory':
+        return MemoryBackend(int(location) if location else 1024)
+    if kind == 'disk':
+        return DiskBackend(location or '.cache')
+    if kind == 'sqlite':
+        return SQLiteBackend(location or 'cache.sqlite')
+    raise ValueError(f"Unknown cache backend in {environmentVariable}: {value!r}")
+
+
+def defaultBackend():
+    global backend
+    with cachesLock:
+        if backend is None:
+            backend = backendFromEnvironment()
+        return backend
+
+
+def setBackend(newBackend):
+    """Use newBackend for all caches that do not have their own backend"""
+    global backend
+    with cachesLock:
+        backend = newBackend
+
+
+def getCache(name, ttl=None):
+    """The cache with this name, created on first use"""
+    with cachesLock:
+        if name not in caches:
+            caches[name] = Cache(name, ttl)
+        return caches[name]
+
+
+def getLRU(name, maxEntries=1024, maxBytes=None):
+    """The in-process LRU with this name, created on first use. Its counters are
+    part of allStats()"""
+    with cachesLock:
+        if name not in caches:
+            caches[name] = LRU(maxEntries, maxBytes)
+        return caches[name]
+
+
+def allStats():
+    with cachesLock:
+        return {name: cache.stats() for name, cache in caches.items()}
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# Python 3
+import os
+import json
+import hashlib
+
+from httpcache import buildResponse, storedHeaders, writeAtomic
+
+__all__ = ['Cassette', 'CassetteMissError', 'fromEnvironment', 'environmentVariable']
+
+# e.g. MENSAHD_CASSETTE=replay:tests/cassettes
+environmentVariable = 'MENSAHD_CASSETTE'
+
+
+class CassetteMissError(IOError):
+    """The request was not recorded, raised in replay mode instead of sending it"""
+
+
+class Cassette:
+    """Upstream requests and their responses on disk.
+    In 'record' mode every response is stored, in 'replay' mode responses are
+    only served from disk and no request is sent. Request headers, e.g. the
+    Authorization header, are neither stored nor part of the key"""
+
+    modes = ('record', 'replay')
+
+    def __init__(self, mode, directory):
+        if mode not in self.modes:
+            raise ValueError(f"Cassette mode must be one of {self.modes}, not {mode!r}")
+        self.mode = mode
+        self.directory = directory
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def _filenames(self, key):
+        name = hashlib.sha256(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.json'), os.path.join(self.directory, f'{name}.body')
+
+    def record(self, key, response):
+        metaFile, bodyFile = self._filenames(key)
+        entry = {
+            'request': repr(key),
+            'url': response.url,
+            'status': response.status_code,
+            'encoding': response.encoding,
+            'headers': storedHeaders(response)
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        writeAtomic(bodyFile, response.content)
+        writeAtomic(metaFile, json.dumps(entry, indent=1))
+
+    def replay(self, key):
+        metaFile, bodyFile = self._filenames(key)
+        try:
+            with open(metaFile, 'r', encoding='utf8') as f:
+                entry = json.load(f)
+            with open(bodyFile, 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise CassetteMissError(f"Not recorded in {self.directory}: {key!r}") from None
+        return buildResponse(entry['url'], entry['status'], entry['headers'], entry['encoding'], body)
+
+
+def fromEnvironment():
+    """Cassette configured with MENSAHD_CASSETTE=mode:directory or None"""
+    value = os.getenv(environmentVariable)
+    if not value:
+        return None
+    mode, _, directory = value.partition(':')
+    return Cassette(mode, directory or 'cassettes')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Python 3
+import time
+import contextlib
+import contextvars
+import concurrent.futures
+
+__all__ = ['DeadlineExceeded', 'within', 'remaining', 'timeout', 'result']
+
+currentDeadline = contextvars.ContextVar('currentDeadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The time of the web request or canteen is used up"""
+
+
+@contextlib.contextmanager
+def within(seconds):
+    """Everything in this context has to finish within seconds. An inner deadline
+    can only shorten the outer one. seconds=None keeps the outer deadline"""
+    current = currentDeadline.get()
+    if seconds is not None:
+        end = time.monotonic() + seconds
+        if current is None or end < current:
+            current = end
+    token = currentDeadline.set(current)
+    try:
+        yield
+    finally:
+        currentDeadline.reset(token)
+
+
+def remaining():
+    """Seconds until the current deadline or None if there is no deadline"""
+    current = currentDeadline.get()
+    if current is None:
+        return None
+    return current - time.monotonic()
+
+
+def timeout(seconds=None):
+    """Timeout for the next blocking call: seconds, or the remaining time if that is shorter.
+    Raises DeadlineExceeded if no time is left"""
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded("No time left for this request")
+    return left if seconds is None else min(seconds, left)
+
+
+def result(future):
+    """future.result(), but give up with DeadlineExceeded at the current deadline"""
+    try:
+        return future.result(timeout=timeout())
+    except concurrent.futures.TimeoutError:
+        if future.done():
+            raise
+        raise DeadlineExceeded("No time left to wait for the result") from None
@@ -8,18 +8,22 @@ import urllib
 import logging
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import SoupStrainer
 
 try:
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, weekdays_map
+    import webclient
+    import runreport
+    import htmlsoup
 except ModuleNotFoundError:
     import sys
 
     include = os.path.relpath(os.path.join(os.path.dirname(__file__), ".."))
     sys.path.insert(0, include)
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, weekdays_map
+    import webclient
+    import runreport
+    import htmlsoup
 
 # Based on https://github.com/mswart/openmensa-parsers/blob/master/magdeburg.py
 
@@ -38,11 +42,8 @@ daysGerman = [
 ]
 
 roles = ("student",)
-
-headers = {
-    "User-Agent": f"{useragentname}/{__version__} ({useragentcomment}) {requests.utils.default_user_agent()}"
-}
-
+# Seconds that a downloaded menu is reused, see webclient.get()
+cacheSeconds = 15 * 60
 
 day_regex = re.compile(r"(?P<date>\d{2}\.\d{2}\.\d{4})")
 euro_regex = re.compile(r"(\d+,\d+) €")
@@ -61,12 +62,13 @@ def parse_url(url, today=False):
         url = url % today.strftime("%Y_%m_%d")
 
     try:
-        content = requests.get(url, headers=headers).text
+        content = webclient.get(url, maxAge=cacheSeconds).text
     except requests.exceptions.ConnectionError as e:
         logging.warning(str(e))
-        content = requests.get(url, headers=headers, verify=False).text
+        content = webclient.get(url, verify=False, maxAge=cacheSeconds).text
 
-    document = BeautifulSoup(content, "html.parser")
+    with runreport.stage('parse'):
+        document = htmlsoup.parse(content, SoupStrainer("h2"), htmlsoup.withClass("div", "et_pb_toggle_item"))
     canteen = StyledLazyBuilder()
 
     if not document.find("h2"):
@@ -226,6 +228,8 @@ def _generateCanteenMeta(name, url_template):
 
 
 class Parser:
+    meta_sources = (metaJson, metaTemplateFile)
+
     def __init__(self, url_template, city, handler, shared_prefix):
         self.url_template = url_template
         self.handler = handler
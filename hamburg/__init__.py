@@ -1,61 +1,123 @@
 #!/usr/bin/env python
 # Python 3
 import sys
-import time
 import os
 import json
 import re
 import logging
 import textwrap
 import urllib.parse
-from threading import Lock
-
-import requests
-import requests.utils
-from bs4 import BeautifulSoup
 
 try:
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, xml_escape, meta_from_xsl, xml_str_param
+    import webclient
+    import runreport
+    import htmlsoup
 except ModuleNotFoundError:
     include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
     sys.path.insert(0, include)
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, xml_escape, meta_from_xsl, xml_str_param
+    import webclient
+    import runreport
+    import htmlsoup
 
 # This parser is similar to Köln: https://github.com/cvzi/mensa/blob/b5673d3437b195057aeea3260e1979b6697ed216/koeln/__init__.py
 
 
 # TODO remove "new" 🆕 from names
 
-headers = {
-    'User-Agent': f'{useragentname}/{__version__} ({useragentcomment}) {requests.utils.default_user_agent()}'
-}
+def _parseMealsDocument(response):
+    """Parse the page of all canteens once and index it by location id:
+    {'legend': {...}, 'locations': {id: [meals of each location container]}, 'options': {ids}}"""
+    with runreport.stage('parse'):
+        document = htmlsoup.parse(
+            response.text,
+            htmlsoup.withClass("div", "tx-epwerkmenu-menu-location-container"),
+            htmlsoup.withClass(None, "menulegend", "mselect__option"))
 
-# Global vars for caching
-cacheMealsLock = Lock()
-cacheMealsDocuments = {}
-cacheMealsTime = {}
+        legend = {
+            "48": "enthält tierisches Lab",  # TODO remove this when it is added to the website?
+        }
+        legend_div = document.find(class_="menulegend")
+        if legend_div:
+            for span in legend_div.find_all(class_="textlegend--bold"):
+                short = span.text.strip()
+                desc = span.parent.find_all('span')[-1].text.strip()
+                legend[short] = desc
+
+        # Canteens in the dropdown selector
+        options = {option.attrs.get("data-filter-id") for option in document.find_all(class_="mselect__option")}
+
+        locations = {}
+        for mensa_div in document.find_all("div", class_="tx-epwerkmenu-menu-location-container"):
+            locations.setdefault(mensa_div.attrs["data-location-id"], []).append(_parseLocation(mensa_div))
+
+        return {'legend': legend, 'locations': locations, 'options': options}
+
+
+def _parseLocation(mensa_div):
+    """List of (date, category, name, notes, prices, roles) of one location container"""
+    meals = []
+    times_wrappers = mensa_div.find_all(
+        class_="tx-epwerkmenu-menu-timestamp-wrapper")
+    for time_wrapper in times_wrappers:
+        date = time_wrapper.attrs["data-timestamp"]
+        category_wrappers = time_wrapper.find_all(
+            "div", class_="menulist__categorywrapper")
+        for category_wrapper in category_wrappers:
+            category_title = category_wrapper.find(
+                class_="menulist__categorytitle")
+            if category_title:
+                category = category_title.text.strip()
+            elif category_wrapper.find(class_="singlemeal--highlight"):
+                category = "Highlight"
+            else:
+                category = "Menü"
+
+            menu_tiles = category_wrapper.find_all(class_="menue-tile")
+            for menu_tile in menu_tiles:
+                mealName = menu_tile.find(
+                    class_="singlemeal__headline").text.strip()
+
+                notes = []
+                roles = []
+                prices = []
+                singleMeal = menu_tile.find(class_="singlemeal")
+
+                for tooltip in singleMeal.find_all(
+                        class_="singlemeal__icontooltip"):
+                    text = tooltip.attrs["title"]
+                    if "<b>" and "</b>" in text:
+                        text = text.split("<b>")[1].split("</b>")[0]
+                    notes.append(text.strip())
+
+                for el in singleMeal.select(
+                        ".dlist .singlemeal__info .singlemeal__info--semibold"):
+                    if "€" in el.text:
+                        m = Parser.euro_regex.search(el.text)
+                        if m:
+                            price = float(f"{m.group(1)}.{m.group(2)}")
+                            role_name = el.next_sibling.strip().lower()
+                            if price and role_name and role_name in Parser.roles_map and Parser.roles_map[
+                                    role_name] not in roles:
+                                roles.append(Parser.roles_map[role_name])
+                                prices.append(price)
+
+                meals.append((date, category, mealName, notes, prices, roles))
+    return meals
 
 
 def _getMealsDocument(url, maxAgeMinutes=20):
-    """Download and parse website, if available use a cached version"""
-    if url in cacheMealsDocuments:
-        ageSeconds = (time.time() - cacheMealsTime[url])
-        if ageSeconds < maxAgeMinutes * 60:
-            logging.debug(f"From cache: {url} [{round(ageSeconds)}s old]")
-            return cacheMealsDocuments[url]
-
-    content = requests.get(url, headers=headers, timeout=10 * 60).text
-    document = BeautifulSoup(content, "html.parser")
-    with cacheMealsLock:
-        cacheMealsDocuments[url] = document
-        cacheMealsTime[url] = time.time()
-    return document
+    """Download the website and index it by canteen, if available use a cached version"""
+    response = webclient.get(url, timeout=10 * 60, maxAge=maxAgeMinutes * 60)
+    # Not parsed again if the page did not change, also in the next run. Only the index is kept, not the soup
+    return webclient.parsed(response, _parseMealsDocument, sizeFactor=1, persistent=True)
 
 
 class Parser:
+    canteen_json = os.path.join(os.path.dirname(__file__), "hamburg.json")
     meta_xslt = os.path.join(os.path.dirname(__file__), "../meta.xsl")
+    meta_sources = (canteen_json, meta_xslt)
     template_meals_url = "https://www.stwhh.de/speiseplan?l={ids}&t={{date}}"
 
     roles_map = {
@@ -68,9 +130,7 @@ class Parser:
 
     def __init__(self, url_template):
 
-        canteen_json = os.path.join(os.path.dirname(__file__), "hamburg.json")
-
-        with open(canteen_json, 'r', encoding='utf8') as f:
+        with open(self.canteen_json, 'r', encoding='utf8') as f:
             canteenDict = json.load(f)
 
         self.meals_url_all_canteens = self.template_meals_url.format(
@@ -85,98 +145,32 @@ class Parser:
                           ["reference"]] = canteenDict[mensaId]
 
     def _parseMealsUrl(self, lazyBuilder, mensaId, t_date):
-        found_any_meals = False
-        document = _getMealsDocument(
+        page = _getMealsDocument(
             self.meals_url_all_canteens.format(date=t_date))
 
-        mensaDivs = document.find_all(
-            "div", class_="tx-epwerkmenu-menu-location-container")
-        mensaDivs = [
-            mensaDiv for mensaDiv in mensaDivs if mensaDiv.attrs["data-location-id"] == str(mensaId)]
+        mensaDivs = page['locations'].get(str(mensaId), [])
 
         if len(mensaDivs) != 1:
             # Check if mensa is in drowndown selector
-            checkbox = document.find(class_="mselect__option", attrs={
-                                     "data-filter-id": str(mensaId)})
-            if checkbox:
+            if str(mensaId) in page['options']:
                 logging.debug(f"No meals found [id='{mensaId}']")
             else:
                 logging.error(f"Mensa not found [id='{mensaId}']")
             return False
 
-        legend_spans = document.find(class_="menulegend").find_all(
-            class_="textlegend--bold")
+        # The index is shared, the builder must not modify it
+        lazyBuilder.setLegendData(dict(page['legend']))
 
-        legend = {
-            "48": "enthält tierisches Lab",  # TODO remove this when it is added to the website?
-        }
-        for span in legend_spans:
-            short = span.text.strip()
-            desc = span.parent.find_all('span')[-1].text.strip()
-            legend[short] = desc
-
-        lazyBuilder.setLegendData(legend)
-
-        mensa_div = mensaDivs.pop()
-
-        times_wrappers = mensa_div.find_all(
-            class_="tx-epwerkmenu-menu-timestamp-wrapper")
-        for time_wrapper in times_wrappers:
-            date = time_wrapper.attrs["data-timestamp"]
-            category_wrappers = time_wrapper.find_all(
-                "div", class_="menulist__categorywrapper")
-            for category_wrapper in category_wrappers:
-                category_title = category_wrapper.find(
-                    class_="menulist__categorytitle")
-                if category_title:
-                    category = category_title.text.strip()
-                elif category_wrapper.find(class_="singlemeal--highlight"):
-                    category = "Highlight"
-                else:
-                    category = "Menü"
-
-                menu_tiles = category_wrapper.find_all(class_="menue-tile")
-                for menu_tile in menu_tiles:
-                    mealName = menu_tile.find(
-                        class_="singlemeal__headline").text.strip()
-
-                    notes = []
-                    roles = []
-                    prices = []
-                    singleMeal = menu_tile.find(class_="singlemeal")
-
-                    for tooltip in singleMeal.find_all(
-                            class_="singlemeal__icontooltip"):
-                        text = tooltip.attrs["title"]
-                        if "<b>" and "</b>" in text:
-                            text = text.split("<b>")[1].split("</b>")[0]
-                        notes.append(text.strip())
-
-                    for el in singleMeal.select(
-                            ".dlist .singlemeal__info .singlemeal__info--semibold"):
-                        if "€" in el.text:
-                            m = self.euro_regex.search(el.text)
-                            if m:
-                                price = float(f"{m.group(1)}.{m.group(2)}")
-                                role_name = el.next_sibling.strip().lower()
-                                if price and role_name and role_name in self.roles_map and self.roles_map[
-                                        role_name] not in roles:
-                                    roles.append(self.roles_map[role_name])
-                                    prices.append(price)
-
-                    for j, mealText in enumerate(
-                            textwrap.wrap(mealName, width=250)):
-                        lazyBuilder.addMeal(date, category, mealText,
-                                            notes if j == 0 else None,
-                                            prices if j == 0 else None,
-                                            roles if j == 0 else None)
-
-                    found_any_meals = True
-
-        if found_any_meals:
-            return True
-
-        return False
+        meals = mensaDivs[0]
+        for date, category, mealName, notes, prices, roles in meals:
+            for j, mealText in enumerate(
+                    textwrap.wrap(mealName, width=250)):
+                lazyBuilder.addMeal(date, category, mealText,
+                                    list(notes) if j == 0 else None,
+                                    prices if j == 0 else None,
+                                    roles if j == 0 else None)
+
+        return bool(meals)
 
     def json(self):
         tmp = {}
@@ -1,26 +1,34 @@
 #!/usr/bin/env python
 # Python 3
-import urllib.request
+import urllib.parse
 import os
 import json
 import re
-import time
 import io
+import copy
+import time
 import logging
-from threading import Lock
+from threading import Lock, Thread, local
+from concurrent.futures import Future
 
 import lxml.etree
 import defusedxml.lxml
 
 try:
-    from version import __version__, useragentname, useragentcomment
     from util import now_local, weekdays_map
+    import webclient
+    import runreport
+    import cache
+    import deadline
 except ModuleNotFoundError:
     import sys
     include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
     sys.path.insert(0, include)
-    from version import __version__, useragentname, useragentcomment
     from util import now_local, weekdays_map
+    import webclient
+    import runreport
+    import cache
+    import deadline
 
 mealsURL = 'https://www.stw.uni-heidelberg.de/appdata/sp.xml'
 mealsURL_authorization = False
@@ -30,7 +38,8 @@ if os.path.isfile(os.path.join(os.path.dirname(__file__), '.password.txt')):
 else:
     mealsURL_authorization = os.getenv('HEIDELBERG_AUTH')
 
-if not mealsURL_authorization:
+if not mealsURL_authorization and not webclient.replaying():
+    # Recorded responses can be replayed without the password
     raise RuntimeError("Authentication data not found")
 
 metaURL = 'https://www.stw.uni-heidelberg.de/sites/default/files/download/pdf/stwhd-de.json'
@@ -84,14 +93,99 @@ weekdays_map = [
     ("So", "sunday")
 ]
 
-# Global vars for caching
-cache_mealsURL_lock = Lock()
-cache_mealsURL_data = None
-cache_mealsURL_time = 0
 
-cache_metaURL_lock = Lock()
-cache_metaURL_data = None
-cache_metaURL_time = 0
+class _RefreshingCache:
+    """Downloaded data that is refreshed in the background when it is older than max_age_seconds.
+    Only one download per process runs at a time; while it runs, callers get the previous copy.
+    Only the very first call waits for the download. After a failed download, no new
+    download starts for retrySeconds. The data is kept in the 'heidelberg' cache, so with a
+    shared backend (MENSAHD_CACHE) the workers share the data, but each worker may still
+    refresh it on its own. With parse, get() returns parse(data), which is called right
+    after each download and again only when the data or version() changes"""
+    retrySeconds = 60
+
+    def __init__(self, name, fetch, parse=None, version=None):
+        self.name = name
+        self.fetch = fetch
+        self.parse = parse
+        self.version = version
+        self.store = cache.getCache('heidelberg')
+        self.lock = Lock()
+        self.loading = None
+        self.refreshing = False
+        self.parsed = (None, None, None)
+        self.failure = None
+        self.retryAt = 0
+
+    def _parsed(self, data):
+        if self.parse is None:
+            return data
+        version = self.version() if self.version else None
+        source, sourceVersion, result = self.parsed
+        # Bytes from the memory backend are the same object, others are compared
+        if sourceVersion != version or (source is not data and source != data):
+            result = self.parse(data)
+            self.parsed = (data, version, result)
+        return result
+
+    def _load(self):
+        try:
+            data = self.fetch()
+        except Exception as e:
+            with self.lock:
+                self.failure = e
+                self.retryAt = time.monotonic() + self.retrySeconds
+            raise
+        with self.lock:
+            self.failure = None
+        self.store.set(self.name, data)
+        logging.info(f"##CACHE## {self.name} cache updated")
+        if self.parse is not None:
+            # Parse in the refresh, so that requests do not wait for it
+            self._parsed(data)
+        return data
+
+    def _refresh(self):
+        try:
+            self._load()
+        except Exception as e:
+            # Keep the previous copy, a call after retrySeconds tries again
+            logging.warning(f"##CACHE## {self.name} refresh failed: {e}")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def get(self, max_age_seconds):
+        """Returns (data, age in seconds)"""
+        # Entries never expire, stale data is served while the refresh runs
+        entry = self.store.getWithAge(self.name, maxAge=float('inf'))
+        with self.lock:
+            waiting = self.retryAt - time.monotonic()
+            failure = self.failure if waiting > 0 else None
+            if entry is None:
+                if failure is not None and self.loading is None:
+                    raise IOError(f"Download of {self.name} failed, next try in {waiting:.0f}s: {failure}")
+                # Nothing to serve yet: the first caller downloads, the others wait for it
+                loading = self.loading
+                owner = loading is None
+                if owner:
+                    loading = self.loading = Future()
+            elif entry[1] > max_age_seconds and not self.refreshing and failure is None:
+                self.refreshing = True
+                Thread(target=self._refresh, name=f"refresh-{self.name}", daemon=True).start()
+
+        if entry is not None:
+            return self._parsed(entry[0]), entry[1]
+        if owner:
+            try:
+                loading.set_result(self._load())
+            except BaseException as e:
+                loading.set_exception(e)
+                raise
+            finally:
+                with self.lock:
+                    self.loading = None
+        return self._parsed(deadline.result(loading)), 0
 
 
 def getEmptyFeed(comment="empty"):
@@ -118,80 +212,131 @@ def _getMealsURL():
     """Download meals information from XML feed"""
     if not mealsURL.startswith("http://") and not mealsURL.startswith("https://"):
         raise RuntimeError(f"mealsUrl is not an allowed URL: '{mealsURL}'")
-    request = urllib.request.Request(mealsURL)
-    request.add_header("Authorization", "Basic %s" % mealsURL_authorization)
-    request.add_header(
-        "User-Agent", f"{useragentname}/{__version__} ({useragentcomment}) Python-urllib/{urllib.request.__version__}")
-    result = urllib.request.urlopen(request, timeout=__timeoutSeconds)  # nosec
-    return result, 0
-
-
-def _getMealsURL_cached(max_age_minutes=15):
-    """Download meals information from XML feed, if available use a cached version"""
-    global cache_mealsURL_lock
-    global cache_mealsURL_data
-    global cache_mealsURL_time
-
-    age_seconds = (time.time() - cache_mealsURL_time)
-    if age_seconds > max_age_minutes*60:
-        with cache_mealsURL_lock:
-            cache_mealsURL_data = _getMealsURL()[0].read()
-            cache_mealsURL_time = time.time()
-            age_seconds = 0
-            logging.info("##CACHE## Meals cache updated")
-
-    return io.BytesIO(cache_mealsURL_data), age_seconds
+    headers = {"Authorization": "Basic %s" % mealsURL_authorization} if mealsURL_authorization else {}
+    result = webclient.get(mealsURL, headers=headers, timeout=__timeoutSeconds)
+    result.raise_for_status()
+    return io.BytesIO(result.content), 0
+
+
+def _getMealsFeeds_cached(max_age_minutes=15):
+    """Rendered feeds of the meals XML feed, if available use a cached version"""
+    return cache_mealsURL.get(max_age_minutes * 60)
+
+
+class _MealsFeeds:
+    """The today and full feeds of all canteens, rendered once per download of the XML feed"""
+
+    def __init__(self, data):
+        with runreport.stage('parse'):
+            dom = defusedxml.lxml.parse(io.BytesIO(data))
+        self.documents = _canteenDocuments(dom)
+        self.lock = Lock()
+        self.feeds = {'': self._render('')}
+        today = now_local().strftime("%Y-%m-%d")
+        self.feeds[today] = self._render(today)
+
+    def _render(self, date):
+        return {name: _generateFeed(self.documents.get(nameMap[name], self.documents[None]), name, date)
+                for name in nameMap}
+
+    def feed(self, name, date, lastFetched=0):
+        """Feed of the canteen for date ('' for all days)"""
+        feeds = self.feeds.get(date)
+        if feeds is None:
+            # A new day since the download
+            with self.lock:
+                feeds = self.feeds.get(date)
+                if feeds is None:
+                    feeds = self._render(date)
+                    self.feeds = {'': self.feeds[''], date: feeds}
+        return _withLastFetched(feeds[name], lastFetched)
+
+
+def _canteenDocuments(dom):
+    """Split the XML feed into one document per canteen, so the XSLT only walks one canteen.
+    The key None is a document without canteens"""
+    root = dom.getroot()
+    documents = {None: lxml.etree.Element(root.tag, root.attrib)}
+    for mensa in root.iterchildren('mensa'):
+        ort = mensa.get('ort')
+        if ort not in documents:
+            documents[ort] = lxml.etree.Element(root.tag, root.attrib)
+        documents[ort].append(copy.deepcopy(mensa))
+    return {ort: lxml.etree.ElementTree(element) for ort, element in documents.items()}
+
+
+def _withLastFetched(feed, lastFetched):
+    """Add the comment of heidelberg.xsl with the age of the data to a feed rendered with lastFetched=0"""
+    if int(lastFetched) <= 1:
+        return feed
+    comment = b'\n  <!--Last updated %d seconds ago-->' % lastFetched
+    start = feed.index(b'<openmensa')
+    end = feed.index(b'>', start)
+    if feed[end - 1:end] == b'/':
+        # <openmensa .../> of a canteen without meals
+        return feed[:end - 1] + b'>' + comment + b'\n</openmensa>' + feed[end + 1:]
+    return feed[:end + 1] + comment + feed[end + 1:]
 
 
 def _getMetaURL():
     """Download meta information from JSON source"""
     if not metaURL.startswith("http://") and not metaURL.startswith("https://"):
         raise RuntimeError("metaURL is not an allowed URL: '%s'" % metaURL)
-    request = urllib.request.Request(metaURL)
-    request.add_header(
-        "User-Agent", f"{useragentname}/{__version__} ({useragentcomment}) Python-urllib/{urllib.request.__version__}")
-    result = urllib.request.urlopen(request, timeout=__timeoutSeconds)  # nosec
-    return result, 0
+    result = webclient.get(metaURL, timeout=__timeoutSeconds)
+    result.raise_for_status()
+    return io.BytesIO(result.content), 0
 
 
 def _getMetaURL_cached(max_age_minutes=120):
     """Download meta information from JSON source, if available use a cached version"""
-    global cache_metaURL_lock
-    global cache_metaURL_data
-    global cache_metaURL_time
-    age_seconds = (time.time() - cache_metaURL_time)
-    if age_seconds > max_age_minutes*60:
-        with cache_metaURL_lock:
-            cache_metaURL_data = _getMetaURL()[0].read()
-            cache_metaURL_time = time.time()
-            age_seconds = 0
-            logging.info("##CACHE## Meta cache updated")
-
-    return io.BytesIO(cache_metaURL_data), age_seconds
-
-
-def _generateFeed(source, name, date='', lastFetched=0):
-    """Generate an openmensa XML feed from the source feed using XSLT"""
+    data, age_seconds = cache_metaURL.get(max_age_minutes * 60)
+    return io.BytesIO(data), age_seconds
+
+
+# Global vars for caching
+# The feeds are rendered again when heidelberg.xsl changes
+cache_mealsURL = _RefreshingCache("Meals", lambda: _getMealsURL()[0].read(), _MealsFeeds,
+                                  lambda: os.stat(xslFile).st_mtime_ns)
+cache_metaURL = _RefreshingCache("Meta", lambda: _getMetaURL()[0].read())
+
+
+# XSLT objects should not be shared between threads
+_xslt = local()
+
+
+def _compiledXslt():
+    """heidelberg.xsl compiled once per thread, and again when the file changes"""
+    modified = os.stat(xslFile).st_mtime_ns
+    compiled = getattr(_xslt, 'compiled', None)
+    if compiled is None or _xslt.modified != modified:
+        xslt_tree = defusedxml.lxml.parse(xslFile)
+        compiled = _xslt.compiled = lxml.etree.XSLT(xslt_tree)
+        _xslt.modified = modified
+    return compiled
+
+
+def _generateFeed(dom, name, date='', lastFetched=0):
+    """Generate an openmensa XML feed from the parsed source feed using XSLT"""
     if date == 'today':
         now = now_local()
         date = now.strftime("%Y-%m-%d")
 
     name = nameMap[name]
 
-    dom = defusedxml.lxml.parse(source)
-    xslt_tree = defusedxml.lxml.parse(xslFile)
-    xslt = lxml.etree.XSLT(xslt_tree)
+    xslt = _compiledXslt()
     newdom = xslt(dom, canteenName=lxml.etree.XSLT.strparam(name), canteenDesiredName=lxml.etree.XSLT.strparam(
         desiredName[name]), specificDate=lxml.etree.XSLT.strparam(date), lastFetched=lxml.etree.XSLT.strparam('%d' % lastFetched))
-    return lxml.etree.tostring(newdom,
-                               pretty_print=True,
-                               xml_declaration=True,
-                               encoding=newdom.docinfo.encoding)
+    with runreport.stage('serialise'):
+        return lxml.etree.tostring(newdom,
+                                   pretty_print=True,
+                                   xml_declaration=True,
+                                   encoding=newdom.docinfo.encoding)
 
 
 def _generateCanteenMeta(source, name, url_template):
     """Generate an openmensa XML meta feed from the source feed using an XML template"""
-    obj = json.loads(source.read().decode("utf-8-sig"))
+    with runreport.stage('parse'):
+        obj = json.loads(source.read().decode("utf-8-sig"))
     with open(metaTemplateFile) as f:
         template = f.read()
 
@@ -256,7 +401,8 @@ def _generateCanteenMeta(source, name, url_template):
 
 def _generateCanteenList_JSON(source, url_template):
     """Generate a JSON file for openmensa.org containing basic information about all available canteens"""
-    obj = json.loads(source.read().decode("utf-8-sig"))
+    with runreport.stage('parse'):
+        obj = json.loads(source.read().decode("utf-8-sig"))
     data = {}
 
     for mensa in obj["mensen"]:
@@ -272,6 +418,9 @@ def _generateCanteenList_JSON(source, url_template):
 
 
 class Parser:
+    # The meta data is downloaded from metaURL, so it cannot be tracked by file
+    meta_sources = None
+
     def __init__(self, url_template):
         self.url_template = url_template
         self.canteens = nameMap
@@ -289,14 +438,14 @@ class Parser:
     @staticmethod
     def feed_today(name=""):
         """Return today's meal feed for openmensa.org"""
-        stream, age_seconds = _getMealsURL_cached()
-        return _generateFeed(stream, name, 'today', age_seconds)
+        feeds, age_seconds = _getMealsFeeds_cached()
+        return feeds.feed(name, now_local().strftime("%Y-%m-%d"), age_seconds)
 
     @staticmethod
     def feed_all(name=""):
         """Return a feed with all available meal information for openmensa.org"""
-        stream, age_seconds = _getMealsURL_cached()
-        return _generateFeed(stream, name, '', age_seconds)
+        feeds, age_seconds = _getMealsFeeds_cached()
+        return feeds.feed(name, '', age_seconds)
 
 
 def getParser(url_template):
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# Python 3
+import re
+
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.filter import ElementFilter
+
+__all__ = ['parse', 'AnyOf', 'withClass', 'features', 'strained']
+
+# lxml builds the tree several times faster than Python's html.parser
+features = 'lxml'
+# Only build the parts of the page that are passed to parse()
+strained = True
+
+
+class AnyOf(ElementFilter):
+    """Keep the elements that match at least one of the SoupStrainers, with all their descendants"""
+
+    def __init__(self, *strainers):
+        super().__init__()
+        self.strainers = strainers
+
+    @property
+    def includes_everything(self):
+        return False
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return any(strainer.allow_tag_creation(nsprefix, name, attrs) for strainer in self.strainers)
+
+    def allow_string_creation(self, string):
+        return any(strainer.allow_string_creation(string) for strainer in self.strainers)
+
+    def match(self, element, _known_rules=False):
+        return any(strainer.match(element, _known_rules) for strainer in self.strainers)
+
+
+def withClass(name, *classNames):
+    """SoupStrainer for name tags with one of the classes. While parsing, the class
+    attribute is still a single string, so class_='row' would not match 'row odd'"""
+    pattern = re.compile(r'(?:^|\s)(?:%s)(?:\s|$)' % '|'.join(re.escape(className) for className in classNames))
+    return SoupStrainer(name, class_=pattern)
+
+
+def parse(content, *only):
+    """BeautifulSoup tree of the html content. If SoupStrainers are given, the tree only
+    contains the elements that match one of them, in document order. Navigation,
+    footers and scripts of the page are then skipped while parsing"""
+    parseOnly = None
+    if only and strained:
+        parseOnly = only[0] if len(only) == 1 else AnyOf(*only)
+    return BeautifulSoup(content, features, parse_only=parseOnly)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Python 3
+import os
+import http
+import json
+import hashlib
+import threading
+
+__all__ = ['HttpCache', 'buildResponse', 'storedHeaders', 'writeAtomic']
+
+
+class HttpCache:
+    """Bodies and validators (ETag / Last-Modified) of GET responses on disk.
+    A stored response is revalidated with If-None-Match / If-Modified-Since and
+    reused if the server answers 304 Not Modified"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _filenames(self, url):
+        name = hashlib.sha256(url.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, f'{name}.json'), os.path.join(self.directory, f'{name}.body')
+
+    def load(self, url):
+        """Stored entry for url or None"""
+        metaFile, bodyFile = self._filenames(url)
+        try:
+            with open(metaFile, 'r', encoding='utf8') as f:
+                entry = json.load(f)
+            with open(bodyFile, 'rb') as f:
+                entry['body'] = f.read()
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    @staticmethod
+    def validators(entry):
+        """Request headers for a conditional GET"""
+        stored = {name.lower(): value for name, value in entry['headers'].items()}
+        headers = {}
+        if stored.get('etag'):
+            headers['If-None-Match'] = stored['etag']
+        if stored.get('last-modified'):
+            headers['If-Modified-Since'] = stored['last-modified']
+        return headers
+
+    def store(self, url, response):
+        """Store a successful response that has a validator. Returns True if it was stored"""
+        if response.status_code != 200 or not ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            return False
+        # Only response headers are stored, never request headers such as Authorization
+        entry = {
+            'url': url,
+            'encoding': response.encoding,
+            'headers': storedHeaders(response)
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        metaFile, bodyFile = self._filenames(url)
+        writeAtomic(bodyFile, response.content)
+        writeAtomic(metaFile, json.dumps(entry, indent=1))
+        return True
+
+    @staticmethod
+    def response(entry, notModified):
+        """Build a response from a stored entry, notModified is the 304 response of the server"""
+        response = buildResponse(entry['url'], 200, entry['headers'], entry['encoding'], entry['body'])
+        # Servers may send updated validators with the 304
+        for name in ('ETag', 'Last-Modified', 'Date', 'Expires', 'Cache-Control'):
+            if name in notModified.headers:
+                response.headers[name] = notModified.headers[name]
+        response.request = notModified.request
+        response.elapsed = notModified.elapsed
+        return response
+
+
+def storedHeaders(response):
+    """Response headers that still apply to the decoded body"""
+    return {name: value for name, value in response.headers.items()
+            if name.lower() not in ('set-cookie', 'content-encoding', 'transfer-encoding', 'content-length')}
+
+
+def buildResponse(url, statusCode, headers, encoding, body):
+    """A requests.Response with the given body, that was not received from the network"""
+    import requests
+    import requests.structures
+    response = requests.models.Response()
+    response.status_code = statusCode
+    try:
+        response.reason = http.HTTPStatus(statusCode).phrase
+    except ValueError:
+        response.reason = ''
+    response.url = url
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.encoding = encoding
+    response._content = body
+    return response
+
+
+def writeAtomic(filename, content):
+    """Write bytes or str to filename via a temporary file"""
+    tempname = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tempname, 'wb') as f:
+        f.write(content.encode('utf8') if isinstance(content, str) else content)
+    os.replace(tempname, filename)
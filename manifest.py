@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# Python 3
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+
+__all__ = ['Manifest', 'manifestFilename', 'stateFilename', 'sha256']
+
+manifestFilename = '.manifest'
+# Not committed: when each file was last checked, in the root directory
+stateFilename = '.manifest-state.json'
+
+
+def sha256(content):
+    if not isinstance(content, bytes):
+        content = content.encode('utf8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class Manifest:
+    """Content hashes of the output files, used to skip writing files that did not change.
+    The files themselves are written by outputwriter.OutputWriter.
+    The manifest only changes when a file changes. The times when unchanged files were
+    last generated are kept in the untracked state file, so a run without changes
+    leaves the manifest as it is"""
+
+    def __init__(self, directory, root='.', stateFile=None):
+        self.directory = directory
+        self.root = root
+        self.filename = os.path.join(directory, manifestFilename)
+        self.stateFile = os.path.join(root, stateFilename) if stateFile is None else stateFile
+        self.checked = {}
+        self.lock = threading.Lock()
+        self.files = {}
+        self.meta = {}
+        self.index = None
+        self.inputCache = {}
+        self.changed = []
+        self.modified = False
+        self.commitLock = threading.Lock()
+        self.closed = False
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'r', encoding='utf8') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            self.meta = data.get('meta', {})
+            self.index = data.get('index')
+        if self.stateFile and os.path.isfile(self.stateFile):
+            try:
+                with open(self.stateFile, 'r', encoding='utf8') as f:
+                    self.checked = json.load(f).get('checked', {})
+            except ValueError:
+                pass
+
+    def key(self, filename):
+        """Path of filename relative to the manifest directory"""
+        return os.path.relpath(filename, self.directory).replace(os.sep, '/')
+
+    def unchanged(self, filename, digest):
+        """Check if filename already exists with the content hash digest"""
+        key = self.key(filename)
+        with self.lock:
+            entry = self.files.get(key)
+        if entry and entry['sha256'] == digest and os.path.isfile(filename):
+            self.touch(filename)
+            return True
+        if not entry and os.path.isfile(filename):
+            # Not in the manifest yet, compare with the existing file
+            with open(filename, 'rb') as f:
+                if sha256(f.read()) == digest:
+                    self.record(filename, digest, changed=False)
+                    return True
+        return False
+
+    def record(self, filename, digest, changed=True):
+        """Store the hash and the time when the file was last generated"""
+        key = self.key(filename)
+        now = int(time.time())
+        with self.lock:
+            self.files[key] = {'sha256': digest, 'time': now}
+            self.checked[key] = now
+            self.modified = True
+            if changed:
+                self.changed.append(filename)
+
+    def touch(self, filename):
+        """Remember that the file was generated again with the same content"""
+        with self.lock:
+            self.checked[self.key(filename)] = int(time.time())
+
+    def _lastGenerated(self, key):
+        return max(self.files.get(key, {}).get('time', 0), self.checked.get(key, 0))
+
+    def lastGenerated(self, keys=None, prefixes=None):
+        """Oldest generation time of the files with these keys or key prefixes. Keys that
+        are not in the manifest are ignored, e.g. a today feed of a parser that has none.
+        If none of the files was ever generated, the time is 0"""
+        with self.lock:
+            times = []
+            if keys:
+                times += [self._lastGenerated(key) for key in keys if key in self.files]
+            if prefixes:
+                times += [self._lastGenerated(key) for key in self.files if key.startswith(prefixes)]
+        return min(times, default=0)
+
+    def seed(self, extensions=('.xml', '.json')):
+        """Add the existing output files once, if the manifest does not know any files yet.
+        Their generation time is unknown, so they count as the most outdated files"""
+        with self.lock:
+            if self.files:
+                return False
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(extensions):
+                    filename = os.path.join(directory, filename)
+                    with open(filename, 'rb') as f:
+                        digest = sha256(f.read())
+                    with self.lock:
+                        self.files[self.key(filename)] = {'sha256': digest, 'time': 0}
+                        self.modified = True
+        return True
+
+    def outputs(self, extensions=('.xml', '.json')):
+        """Keys of all known output files with these extensions. Files that no longer
+        exist are removed from the manifest"""
+        with self.lock:
+            missing = [key for key in self.files if not os.path.isfile(os.path.join(self.directory, key))]
+            for key in missing:
+                del self.files[key]
+                self.checked.pop(key, None)
+                self.modified = True
+            return sorted(key for key in self.files if key.endswith(extensions))
+
+    def indexUpToDate(self, digest, filename):
+        """Check if the index file was rendered from the inputs with this hash"""
+        with self.lock:
+            return self.index == digest and os.path.isfile(filename)
+
+    def recordIndex(self, digest):
+        with self.lock:
+            if self.index != digest:
+                self.index = digest
+                self.modified = True
+
+    def inputDigests(self, filenames):
+        """Content hashes of input files, keys are relative to the root directory"""
+        digests = {}
+        for filename in filenames:
+            key = os.path.relpath(os.path.join(self.root, filename), self.root).replace(os.sep, '/')
+            with self.lock:
+                digest = self.inputCache.get(key, False)
+            if digest is False:
+                try:
+                    with open(os.path.join(self.root, key), 'rb') as f:
+                        digest = sha256(f.read())
+                except FileNotFoundError:
+                    digest = None
+                with self.lock:
+                    self.inputCache[key] = digest
+            digests[key] = digest
+        return digests
+
+    def _currentFile(self, key):
+        return key in self.files and os.path.isfile(os.path.join(self.directory, key))
+
+    def metaUpToDate(self, parserName, inputs, url, filename):
+        """Check if the meta file was generated from exactly these inputs"""
+        key = self.key(filename)
+        with self.lock:
+            record = self.meta.get(parserName)
+            if not record or record['inputs'] != inputs or record['url'] != url:
+                return False
+            return key in record['outputs'] and self._currentFile(key)
+
+    def recordMeta(self, parserName, inputs, url, filename):
+        """Remember that the meta file was generated from these inputs"""
+        key = self.key(filename)
+        with self.lock:
+            record = self.meta.get(parserName)
+            if not record or record['inputs'] != inputs or record['url'] != url:
+                record = self.meta[parserName] = {
+                    'inputs': inputs, 'url': url, 'outputs': [], 'complete': False}
+            if key not in record['outputs']:
+                record['outputs'].append(key)
+                record['outputs'].sort()
+                self.modified = True
+
+    def completeMeta(self, parserName):
+        """Mark that the meta files of all canteens of the parser are recorded"""
+        with self.lock:
+            record = self.meta.get(parserName)
+            if record and not record['complete']:
+                record['complete'] = True
+                self.modified = True
+
+    def allMetaUpToDate(self, parserName, url):
+        """Check if all meta files of a parser are current, without loading the parser"""
+        with self.lock:
+            record = self.meta.get(parserName)
+        if not record or not record['complete'] or record['url'] != url:
+            return False
+        if self.inputDigests(record['inputs'].keys()) != record['inputs']:
+            return False
+        with self.lock:
+            return all(self._currentFile(key) for key in record['outputs'])
+
+    @contextlib.contextmanager
+    def committing(self):
+        """Context for moving files into place, yields False if the manifest is closed"""
+        with self.commitLock:
+            yield not self.closed
+
+    def close(self):
+        """Wait for running commits, later commits are discarded. Call before save()
+        if workers may still be running"""
+        with self.commitLock:
+            self.closed = True
+
+    def save(self):
+        """Store the state file and the manifest file, if any entries of the manifest were
+        added or changed. Returns True if the manifest was written"""
+        with self.lock:
+            state = json.dumps({'checked': self.checked}, sort_keys=True)
+            modified, self.modified = self.modified, False
+            if modified:
+                content = json.dumps({'files': self.files, 'meta': self.meta, 'index': self.index},
+                                     indent=1, sort_keys=True) + '\n'
+        if self.stateFile:
+            self._write(self.stateFile, state)
+        if not modified:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(self.filename, content)
+        with self.lock:
+            self.changed.append(self.filename)
+        return True
+
+    @staticmethod
+    def _write(filename, content):
+        tempname = f'{filename}.tmp'
+        with open(tempname, 'w', encoding='utf8') as f:
+            f.write(content)
+        os.replace(tempname, filename)
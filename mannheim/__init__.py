@@ -11,24 +11,27 @@ import bs4
 
 
 try:
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, xml_escape, meta_from_xsl, xml_str_param
+    import webclient
+    import runreport
+    import htmlsoup
 except ModuleNotFoundError:
     include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
     sys.path.insert(0, include)
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, xml_escape, meta_from_xsl, xml_str_param
+    import webclient
+    import runreport
+    import htmlsoup
 
 
 class Parser:
     canteen_json = os.path.join(os.path.dirname(__file__), "canteens.json")
     meta_xslt = os.path.join(os.path.dirname(__file__), "../meta.xsl")
     feed_xslt = os.path.join(os.path.dirname(__file__), "feed.xsl")
-    headers = {
-        'User-Agent': f'{useragentname}/{__version__} ({useragentcomment}) {requests.utils.default_user_agent()}'
-    }
+    meta_sources = (canteen_json, meta_xslt)
 
     source_url = "https://www.stw-ma.de/essen-trinken/speiseplaene/wochenansicht"
+    cacheSeconds = 15 * 60
     source_parameters = "?location={location}&date={year}-{month}-{day}&lang=de"
     source_parameters_meta = "?location={location}&lang=de"
 
@@ -52,39 +55,54 @@ class Parser:
 
     roles = ('student', 'employee', 'other')
 
-    def feed(self, ref: str) -> str:
-        """Generate an openmensa XML feed"""
-        if ref not in self.canteens:
-            return f"Unknown canteen with ref='{xml_escape(ref)}'"
-
-        if "loc" not in self.canteens[ref]:
-            return f"Canteen with ref='{xml_escape(ref)}' has no loc-id"
-
+    def _feedUrl(self, ref):
+        """Week view of the canteen that contains today"""
         today = now_local()
         if today.weekday() == 6:  # Sunday
             today += datetime.timedelta(days=1)  # Tomorrow
 
-        url = self.source_url + self.source_parameters.format(
+        return self.source_url + self.source_parameters.format(
             location=self.canteens[ref]["loc"],
             year=today.strftime('%Y'),
             month=today.strftime('%m'),
             day=today.strftime('%d')
         )
 
+    def prefetch(self, names, today=False):
+        """Download the week views of all canteens at once, feed() then uses
+        the responses from webclient.requestCache()"""
+        if today:
+            # There is no feed_today, -today does not use the week views
+            return
+        webclient.fetchAll([('GET', self._feedUrl(ref), {'maxAge': self.cacheSeconds})
+                            for ref in names if "loc" in self.canteens.get(ref, {})])
+
+    def feed(self, ref: str) -> str:
+        """Generate an openmensa XML feed"""
+        if ref not in self.canteens:
+            return f"Unknown canteen with ref='{xml_escape(ref)}'"
+
+        if "loc" not in self.canteens[ref]:
+            return f"Canteen with ref='{xml_escape(ref)}' has no loc-id"
+
+        url = self._feedUrl(ref)
+
         if not url.startswith("http://") and not url.startswith("https://"):
             raise RuntimeError("url is not an allowed URL: '%s'" % url)
 
         try:
-            content = requests.get(url, headers=self.headers).text
+            content = webclient.get(url, maxAge=self.cacheSeconds).text
         except requests.exceptions.ConnectionError as e:
             logging.warning(e)
-            content = requests.get(
-                url, headers=self.headers, verify=False).text
+            content = webclient.get(
+                url, verify=False, maxAge=self.cacheSeconds).text
 
         # Fix table
         content = content.replace("</th>", "</td>").replace("<th ", "<td ")
 
-        document = bs4.BeautifulSoup(content, "html.parser")
+        with runreport.stage('parse'):
+            document = htmlsoup.parse(
+                content, bs4.SoupStrainer("h2"), bs4.SoupStrainer(id=["legend", "message", "previewTable"]))
         canteen = StyledLazyBuilder()
 
         # date
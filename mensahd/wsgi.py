@@ -5,6 +5,8 @@
 import sys
 import os
 import socket
+import importlib
+import threading
 import urllib.error
 import urllib.request
 import traceback
@@ -17,14 +19,13 @@ if __name__ == '__main__':
     sys.path.insert(0, include)
 
 from version import __version__
-from eppelheim import getParser as geteppelheim
-from stuttgart import getParser as getstuttgart
-from mannheim import getParser as getmannheim
-from heidelberg import getParser as getheidelberg
-from ulm import getParser as getulm
+import deadline
 
 page_errors = []
 
+# Gunicorn kills a worker after 60 seconds, answer with 504 before that
+requestSeconds = 50
+
 baseurl = os.getenv("PUBLIC_URL", False)
 if not baseurl:
     if __name__ == '__main__' or 'idlelib' in sys.modules:
@@ -32,11 +33,33 @@ if not baseurl:
     else:
         raise RuntimeError("Environment variable PUBLIC_URL is not set.")
 
-heidelberg = getheidelberg(baseurl)
-mannheim = getmannheim(baseurl)
-stuttgart = getstuttgart(baseurl)
-eppelheim = geteppelheim(baseurl)
-ulm = getulm(baseurl)
+
+class LazyParser:
+    """Imports the parser module and creates the parser on first use,
+    so the parser's dependencies are only loaded when one of its pages is requested.
+    moduleName is available without loading the parser"""
+
+    def __init__(self, moduleName):
+        self.moduleName = moduleName
+        self._parser = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._parser is None:
+                module = importlib.import_module(self.moduleName)
+                self._parser = module.getParser(baseurl)
+        return self._parser
+
+    def __getattr__(self, name):
+        return getattr(self._parser or self._load(), name)
+
+
+heidelberg = LazyParser('heidelberg')
+mannheim = LazyParser('mannheim')
+stuttgart = LazyParser('stuttgart')
+eppelheim = LazyParser('eppelheim')
+ulm = LazyParser('ulm')
 
 
 def timeStrBerlin():
@@ -45,7 +68,20 @@ def timeStrBerlin():
     return now.strftime("%Y-%m-%d %H:%M")
 
 
+def errorStatus(e, status):
+    """504 if the request ran out of time, otherwise status"""
+    if isinstance(e, deadline.DeadlineExceeded):
+        return '504 Gateway Timeout'
+    return status
+
+
 def application(environ, start_response):
+    """All upstream requests share the time of the web request"""
+    with deadline.within(requestSeconds):
+        return _application(environ, start_response)
+
+
+def _application(environ, start_response):
     ctype = 'text/plain; charset=utf-8'
     cache_control = 'no-cache, no-store, must-revalidate'
     status = '200 OK'
@@ -77,7 +113,7 @@ def application(environ, start_response):
                 if not url.startswith("http://") and not url.startswith("https://"):
                     raise RuntimeError(f"url is not an allowed URL: '{url}'")
                 request = urllib.request.Request(url)
-                result = urllib.request.urlopen(request, timeout=7)  # nosec
+                result = urllib.request.urlopen(request, timeout=deadline.timeout(7))  # nosec
                 if result.getcode() != 200:
                     raise RuntimeError("HTTP status code: %r" % result.status)
             except (urllib.error.URLError, socket.timeout) as e:
@@ -114,11 +150,11 @@ def application(environ, start_response):
             name = ''
         try:
             response_body = heidelberg.feed_today(name).decode("utf-8")
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to www.stw.uni-heidelberg.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open www.stw.uni-heidelberg.de timed out'
+            status = errorStatus(e, '533 Open www.stw.uni-heidelberg.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -137,11 +173,11 @@ def application(environ, start_response):
             name = ''
         try:
             response_body = heidelberg.feed_all(name).decode("utf-8")
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to www.stw.uni-heidelberg.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open www.stw.uni-heidelberg.de timed out'
+            status = errorStatus(e, '533 Open www.stw.uni-heidelberg.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -160,14 +196,14 @@ def application(environ, start_response):
             name = ''
         try:
             response_body = heidelberg.meta(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Error opening www.stw.uni-heidelberg.de: %s\n\n%s" % (
                 e, traceback.format_exc())
             if 'time' in str(e):
                 status = '504 Open www.stw.uni-heidelberg.de timed out'
             else:
-                status = '503 %s' % (e, )
+                status = errorStatus(e, '503 %s' % (e, ))
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -180,14 +216,14 @@ def application(environ, start_response):
         ctype = 'application/xml; charset=utf-8'
         try:
             response_body = heidelberg.list()
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Error opening www.stw.uni-heidelberg.de: %s\n\n%s" % (
                 e, traceback.format_exc())
             if 'time' in str(e):
                 status = '504 Open www.stw.uni-heidelberg.de timed out'
             else:
-                status = '503 %s' % (e, )
+                status = errorStatus(e, '503 %s' % (e, ))
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -200,14 +236,14 @@ def application(environ, start_response):
         ctype = 'application/json; charset=utf-8'
         try:
             response_body = heidelberg.json()
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Error opening www.stw.uni-heidelberg.de: %s\n\n%s" % (
                 e, traceback.format_exc())
             if 'time' in str(e):
                 status = '504 Open www.stw.uni-heidelberg.de timed out'
             else:
-                status = '503 %s' % (e, )
+                status = errorStatus(e, '503 %s' % (e, ))
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -229,7 +265,7 @@ def application(environ, start_response):
             ctype = 'text/plain; charset=utf-8'
             response_body = "An error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '503 Service Unavailable'
+            status = errorStatus(e, '503 Service Unavailable')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
 
     elif environ['PATH_INFO'].startswith('/mannheim/meta/'):
@@ -239,11 +275,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = mannheim.meta(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to www.stw-ma.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open www.stw-ma.de timed out'
+            status = errorStatus(e, '533 Open www.stw-ma.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -259,11 +295,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = mannheim.feed_today(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to studiplus.stw-ma.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open studiplus.stw-ma.de timed out'
+            status = errorStatus(e, '533 Open studiplus.stw-ma.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -279,11 +315,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = mannheim.feed_all(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to studiplus.stw-ma.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open studiplus.stw-ma.de timed out'
+            status = errorStatus(e, '533 Open studiplus.stw-ma.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -317,7 +353,7 @@ def application(environ, start_response):
             ctype = 'text/plain; charset=utf-8'
             response_body = "An error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '503 Service Unavailable'
+            status = errorStatus(e, '503 Service Unavailable')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
 
     elif environ['PATH_INFO'].startswith('/stuttgart/meta/'):
@@ -327,11 +363,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = stuttgart.meta(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to sws2.maxmanager.xyz\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open sws2.maxmanager.xyz timed out'
+            status = errorStatus(e, '533 Open sws2.maxmanager.xyz timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -347,11 +383,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = stuttgart.feed_today(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to sws2.maxmanager.xyz\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open sws2.maxmanager.xyz timed out'
+            status = errorStatus(e, '533 Open sws2.maxmanager.xyz timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -367,11 +403,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = stuttgart.feed_all(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to sws2.maxmanager.xyz\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open sws2.maxmanager.xyz timed out'
+            status = errorStatus(e, '533 Open sws2.maxmanager.xyz timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -404,7 +440,7 @@ def application(environ, start_response):
             ctype = 'text/plain; charset=utf-8'
             response_body = "An error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '503 Service Unavailable'
+            status = errorStatus(e, '503 Service Unavailable')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
 
     elif environ['PATH_INFO'].startswith('/eppelheim/meta/'):
@@ -414,11 +450,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = eppelheim.meta(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to www.stw-ma.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open www.stw-ma.de timed out'
+            status = errorStatus(e, '533 Open www.stw-ma.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -434,11 +470,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = eppelheim.feed(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to www.stw-ma.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open www.stw-ma.de timed out'
+            status = errorStatus(e, '533 Open www.stw-ma.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -470,7 +506,7 @@ def application(environ, start_response):
             ctype = 'text/plain; charset=utf-8'
             response_body = "An error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '503 Service Unavailable'
+            status = errorStatus(e, '503 Service Unavailable')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
 
     elif environ['PATH_INFO'].startswith('/ulm/meta/'):
@@ -484,7 +520,7 @@ def application(environ, start_response):
             ctype = 'text/plain; charset=utf-8'
             response_body = "An error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '503 Service Unavailable'
+            status = errorStatus(e, '503 Service Unavailable')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
 
     elif environ['PATH_INFO'].startswith('/ulm/feed/'):
@@ -494,11 +530,11 @@ def application(environ, start_response):
             name = name[:-4]
         try:
             response_body = ulm.feed(name)
-        except (urllib.error.URLError, socket.timeout) as e:
+        except IOError as e:
             ctype = 'text/plain; charset=utf-8'
             response_body = "Could not connect to www.uni-ulm.de\n\nAn error occured:\n%s\n%s" % (
                 e, traceback.format_exc())
-            status = '533 Open www.uni-ulm.de timed out'
+            status = errorStatus(e, '533 Open www.uni-ulm.de timed out')
             page_errors.append((timeStrBerlin(), environ['PATH_INFO'], e))
         except Exception as e:
             ctype = 'text/plain; charset=utf-8'
@@ -525,7 +561,7 @@ def application(environ, start_response):
     elif environ['PATH_INFO'] == '/api':
         links = []
         for parser in (heidelberg, eppelheim, mannheim, stuttgart, ulm):
-            moduleName = parser.__module__
+            moduleName = parser.moduleName
             if moduleName == 'heidelberg':
                 moduleName = ''
             else:
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# Python 3
+import os
+import shutil
+import tempfile
+import threading
+
+from manifest import sha256
+
+__all__ = ['OutputWriter']
+
+
+class OutputWriter:
+    """Writes output files in batches: files are staged in a temporary directory and
+    moved into place with os.replace() when commit() is called. Files whose content
+    did not change according to the manifest are skipped"""
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.staged = []
+        self.counter = 0
+        self.stagingDirectory = None
+
+    def _stagingDirectory(self):
+        with self.lock:
+            if self.stagingDirectory is None:
+                # Next to the output directory, so os.replace() does not cross file systems
+                parent = os.path.dirname(os.path.normpath(os.path.abspath(self.manifest.directory)))
+                self.stagingDirectory = tempfile.mkdtemp(prefix='.staging-', dir=parent)
+            return self.stagingDirectory
+
+    def write(self, filename, content, onCommit=None):
+        """Stage content for filename. Returns False if the file already has this content.
+        onCommit() is called when the file is in place, right away if it is unchanged"""
+        if not isinstance(content, bytes):
+            content = content.encode('utf8')
+        digest = sha256(content)
+        if self.manifest.unchanged(filename, digest):
+            if onCommit:
+                onCommit()
+            return False
+        stagingDirectory = self._stagingDirectory()
+        with self.lock:
+            self.counter += 1
+            tempname = os.path.join(stagingDirectory, f'{self.counter}.tmp')
+        with open(tempname, 'xb') as f:
+            f.write(content)
+        with self.lock:
+            self.staged.append((tempname, filename, digest, onCommit))
+        return True
+
+    def commit(self):
+        """Move all staged files to their destination. Returns the number of files, or None
+        if the manifest was already closed and the files were discarded"""
+        with self.lock:
+            staged, self.staged = self.staged, []
+        with self.manifest.committing() as isOpen:
+            if not isOpen:
+                self._removeStagingDirectory()
+                return None
+            for directory in sorted({os.path.dirname(filename) for _, filename, _, _ in staged}):
+                os.makedirs(directory, exist_ok=True)
+            for tempname, filename, digest, onCommit in staged:
+                os.replace(tempname, filename)
+                self.manifest.record(filename, digest)
+                if onCommit:
+                    onCommit()
+        self._removeStagingDirectory()
+        return len(staged)
+
+    def discard(self):
+        """Throw away all staged files"""
+        with self.lock:
+            self.staged = []
+        self._removeStagingDirectory()
+
+    def _removeStagingDirectory(self):
+        with self.lock:
+            directory, self.stagingDirectory = self.stagingDirectory, None
+        if directory:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# Python 3
+import json
+import time
+import datetime
+import threading
+import contextlib
+import contextvars
+
+__all__ = ['Record', 'Report', 'recording', 'stage', 'addRequest', 'addOutput']
+
+currentRecord = contextvars.ContextVar('currentRecord', default=None)
+# Stages inside another stage, e.g. the concurrent requests of webclient.fetchAll(), are not timed again
+currentStage = contextvars.ContextVar('currentStage', default=None)
+
+
+class Record:
+    """Wall time per stage, requests and output size of one unit of work, e.g. a canteen.
+    The 'build' stage is the wall time that is not spent in any of the other stages"""
+    stages = ('fetch', 'parse', 'serialise')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.requests = 0
+        self.bytesDownloaded = 0
+        self.bytesTransferred = 0
+        self.outputBytes = 0
+        self.started = time.perf_counter()
+        self.wall = None
+
+    def add(self, stageName, seconds):
+        with self.lock:
+            self.seconds[stageName] += seconds
+
+    def finish(self):
+        self.wall = time.perf_counter() - self.started
+
+    def toDict(self):
+        wall = self.wall if self.wall is not None else time.perf_counter() - self.started
+        data = {'wall': round(wall, 4)}
+        for stageName in self.stages:
+            data[stageName] = round(self.seconds[stageName], 4)
+        data['build'] = round(max(0.0, wall - sum(self.seconds.values())), 4)
+        data['requests'] = self.requests
+        data['bytesDownloaded'] = self.bytesDownloaded
+        data['bytesTransferred'] = self.bytesTransferred
+        data['outputBytes'] = self.outputBytes
+        return data
+
+
+class Report:
+    """Collects the records of all parsers and canteens of a run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.startedCounter = time.perf_counter()
+        self.parsers = {}
+        # Hit rates of the caches, see cache.allStats()
+        self.caches = {}
+
+    def add(self, parserName, record, canteen=None):
+        with self.lock:
+            parser = self.parsers.setdefault(parserName, {'setup': None, 'canteens': {}, 'total': None})
+            if canteen is None:
+                parser['setup'] = record
+            else:
+                parser['canteens'][canteen] = record
+
+    def addParser(self, parserName, record):
+        """The record of the whole parser. The canteens may run at the same time, so its
+        wall time is the time of the parser, not the sum of the canteens"""
+        with self.lock:
+            self.parsers.setdefault(parserName, {'setup': None, 'canteens': {}, 'total': None})['total'] = record
+
+    def toDict(self):
+        with self.lock:
+            parsers = {}
+            for parserName, parser in self.parsers.items():
+                parsers[parserName] = {
+                    'setup': parser['setup'].toDict() if parser['setup'] else None,
+                    'canteens': {canteen: record.toDict() for canteen, record in parser['canteens'].items()},
+                    'wall': parser['total'].toDict()['wall'] if parser['total'] else None
+                }
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall': round(time.perf_counter() - self.startedCounter, 4),
+            'parsers': parsers,
+            'caches': self.caches
+        }
+
+    def save(self, filename):
+        with open(filename, 'w', encoding='utf8') as f:
+            json.dump(self.toDict(), f, indent=2)
+
+
+@contextlib.contextmanager
+def recording(record=None):
+    """Collect the timings of the current thread/task in record"""
+    record = record or Record()
+    token = currentRecord.set(record)
+    try:
+        yield record
+    finally:
+        record.finish()
+        currentRecord.reset(token)
+
+
+@contextlib.contextmanager
+def stage(stageName):
+    """Add the time spent in this context to a stage of the current record.
+    Only the outermost stage is timed"""
+    record = currentRecord.get()
+    if record is None or currentStage.get() is not None:
+        yield
+        return
+    token = currentStage.set(stageName)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.add(stageName, time.perf_counter() - started)
+        currentStage.reset(token)
+
+
+def addRequest(numberOfBytes, transferredBytes=None):
+    """Count a request with the size of the body and the size on the wire, e.g. compressed"""
+    record = currentRecord.get()
+    if record is not None:
+        with record.lock:
+            record.requests += 1
+            record.bytesDownloaded += numberOfBytes
+            record.bytesTransferred += numberOfBytes if transferredBytes is None else transferredBytes
+
+
+def addOutput(content):
+    record = currentRecord.get()
+    if record is not None:
+        with record.lock:
+            record.outputBytes += len(content.encode('utf8') if isinstance(content, str) else content)
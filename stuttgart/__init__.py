@@ -7,18 +7,19 @@ import urllib
 import re
 import logging
 
-import requests
-from bs4 import BeautifulSoup
-
 try:
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, weekdays_map
+    import webclient
+    import runreport
+    import htmlsoup
 except ModuleNotFoundError:
     import sys
     include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
     sys.path.insert(0, include)
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, weekdays_map
+    import webclient
+    import runreport
+    import htmlsoup
 
 metaJson = os.path.join(os.path.dirname(__file__), "stuttgart.json")
 
@@ -28,6 +29,8 @@ metaTemplateFile = os.path.join(os.path.dirname(
 url = r"https://sws2.maxmanager.xyz/inc/ajax-php_konnektor.inc.php"
 sourceUrl = r"https://www.studierendenwerk-stuttgart.de/essen/speiseplan/"
 roles = ('student', 'employee', 'other')
+# Seconds that a downloaded menu is reused, see webclient.get()
+cacheSeconds = 15 * 60
 price_pattern = re.compile('\\d+,\\d\\d')
 
 ingredients = {
@@ -81,11 +84,8 @@ ingredients = {
 }
 
 
-def parse_url(canteen, locId, day=None):
-
-    if day is None:
-        day = datetime.date.today()
-
+def _request(locId, day):
+    """Arguments for webclient.post() to get the menu of one day"""
     date = day.strftime("%Y-%m-%d")
 
     headers = {
@@ -106,11 +106,22 @@ def parse_url(canteen, locId, day=None):
     data = "func=make_spl&locId=%s&date=%s&lang=de&startThisWeek=%s&startNextWeek=%s" % (
         locId, date, startThisWeek, startNextWeek)
 
-    r = requests.post(url, data=data, headers=headers)
+    return dict(data=data, headers=headers, maxAge=cacheSeconds)
+
+
+def parse_url(canteen, locId, day=None):
+
+    if day is None:
+        day = datetime.date.today()
+
+    date = day.strftime("%Y-%m-%d")
+
+    r = webclient.post(url, **_request(locId, day))
 
     content = r.content.decode("utf-8")
 
-    document = BeautifulSoup(content, "html.parser")
+    with runreport.stage('parse'):
+        document = htmlsoup.parse(content, htmlsoup.withClass("div", "container-fluid"))
 
     divs = document.find(
         "div", {"class": "container-fluid"}).find_all("div", {"class", "row"})
@@ -259,6 +270,8 @@ def _generateCanteenMeta(obj, name,  url_template):
 
 
 class Parser:
+    meta_sources = (metaJson, metaTemplateFile)
+
     def __init__(self, url_template, handler):
         self.url_template = url_template
         with open(metaJson) as f:
@@ -272,6 +285,8 @@ class Parser:
             self.xml2locId[mensa["xml"]] = mensa["locId"]
 
         self.handler = handler
+        # Feeds that prefetch() has already built
+        self.prefetched = {}
 
     def json(self):
         tmp = {}
@@ -283,6 +298,32 @@ class Parser:
     def meta(self, name):
         return _generateCanteenMeta(self.metaObj, name, self.url_template)
 
+    def prefetch(self, names, today=False):
+        """Download the days of all canteens at once. For feed_all() the canteens are
+        built together, one day per batch of requests, so only the days that
+        feed_all() reads are requested"""
+        first = now_local()
+        if today:
+            webclient.fetchAll([('POST', url, _request(self.xml2locId[name], first.date()))
+                                for name in names])
+            return
+        canteens = {name: StyledLazyBuilder() for name in names}
+        running = {name: _feedDays(first) for name in names}
+        days = {name: next(days) for name, days in running.items()}
+        while days:
+            webclient.fetchAll([('POST', url, _request(self.xml2locId[name], date.date()))
+                                for name, date in days.items()])
+            for name, date in list(days.items()):
+                try:
+                    days[name] = running[name].send(self.handler(canteens[name], self.xml2locId[name], date.date()))
+                except StopIteration:
+                    del days[name]
+                    self.prefetched[name] = canteens[name].toXMLFeed()
+                except Exception as e:
+                    # feed_all() requests the days again and reports the error
+                    del days[name]
+                    logging.debug(f"Prefetching {name} failed: {e}")
+
     def feed_today(self, name):
         today = now_local().date()
         canteen = StyledLazyBuilder()
@@ -291,32 +332,44 @@ class Parser:
         return canteen.toXMLFeed()
 
     def feed_all(self, name):
+        if name in self.prefetched:
+            return self.prefetched.pop(name)
+
         canteen = StyledLazyBuilder()
+        days = _feedDays(now_local())
+        date = next(days)
+        try:
+            while True:
+                date = days.send(self.handler(canteen, self.xml2locId[name], date.date()))
+        except StopIteration:
+            pass
+
+        return canteen.toXMLFeed()
 
-        date = now_local()
 
-        # Get this week
+def _feedDays(date):
+    """Days of feed_all(), starting at date. Send whether the day had any meals: the week
+    ends at the first day without meals, and next week is only read after a weekend"""
+    # Get this week
+    lastWeekday = -1
+    while (yield date):
+        date += datetime.timedelta(days=1)
+        if lastWeekday > date.weekday():
+            break
+        lastWeekday = date.weekday()
+
+    # Skip over weekend
+    if date.weekday() > 4:
+        date += datetime.timedelta(days=7-date.weekday())
+
+        # Get next week
         lastWeekday = -1
-        while self.handler(canteen, self.xml2locId[name], date.date()):
+        while (yield date):
             date += datetime.timedelta(days=1)
             if lastWeekday > date.weekday():
                 break
             lastWeekday = date.weekday()
 
-        # Skip over weekend
-        if date.weekday() > 4:
-            date += datetime.timedelta(days=7-date.weekday())
-
-            # Get next week
-            lastWeekday = -1
-            while self.handler(canteen, self.xml2locId[name], date.date()):
-                date += datetime.timedelta(days=1)
-                if lastWeekday > date.weekday():
-                    break
-                lastWeekday = date.weekday()
-
-        return canteen.toXMLFeed()
-
 
 def getParser(url_template):
     parser = Parser(url_template, parse_url)
@@ -0,0 +1,122 @@
+import sys
+import os
+import time
+import logging
+import tempfile
+
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, include)
+
+import cache  # noqa: E402
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+
+def checkBackend(backend):
+    store = cache.Cache('test', ttl=60, backend=backend)
+    assert store.get('a') is None
+    store.set('a', {'bytes': b'\x00\x01', 'list': [1, 2]})
+    assert store.get('a') == {'bytes': b'\x00\x01', 'list': [1, 2]}
+    # Namespaces do not share keys
+    assert cache.Cache('other', backend=backend).get('a') is None
+
+    # Expired entries are only returned if they are younger than maxAge
+    store.set('b', 'old', ttl=-1)
+    assert store.get('b') is None
+    value, age = store.getWithAge('b', maxAge=60)
+    assert value == 'old' and 0 <= age < 60
+
+    assert store.getOrSet('c', lambda: 'computed') == 'computed'
+    assert store.getOrSet('c', lambda: 'again') == 'computed'
+    store.delete('c')
+    assert store.get('c') is None
+    assert store.stats()['hits'] == 3, store.stats()
+
+
+def test_memory_backend():
+    checkBackend(cache.MemoryBackend())
+    backend = cache.MemoryBackend(maxEntries=2)
+    store = cache.Cache('lru', backend=backend)
+    store.set('a', 1)
+    store.set('b', 2)
+    store.get('a')
+    store.set('c', 3)
+    # 'b' was the least recently used entry
+    assert (store.get('a'), store.get('b'), store.get('c')) == (1, None, 3)
+
+
+def test_lru_bytes():
+    lru = cache.LRU(maxEntries=10, maxBytes=100)
+    lru.set('a', 'A', size=40)
+    lru.set('b', 'B', size=40)
+    assert lru.get('a') == 'A'
+    lru.set('c', 'C', size=40)
+    # 'b' was evicted to stay below 100 bytes
+    assert lru.get('b') is None and lru.get('c') == 'C'
+    # A single entry that is too large is still kept until the next one arrives
+    lru.set('d', 'D', size=500)
+    assert lru.get('d') == 'D' and lru.get('a') is None
+    stats = lru.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries'], stats['bytes']) == (3, 2, 3, 1, 500), stats
+
+
+def test_memory_bytes():
+    backend = cache.MemoryBackend(maxEntries=10, maxBytes=1000)
+    store = cache.Cache('bodies', backend=backend)
+    store.set('a', ('url', b'x' * 600))
+    store.set('b', ('url', b'x' * 600))
+    assert store.get('a') is None and store.get('b') is not None
+
+
+def checkPurge(backend):
+    old = cache.Cache('old', backend=backend)
+    old.set('expired', 1, ttl=-1)
+    old.set('fresh', 2, ttl=60)
+    old.set('forever', 3)
+    backend.purge(time.time())
+    assert old.getWithAge('expired', maxAge=60) is None
+    assert (old.get('fresh'), old.get('forever')) == (2, 3)
+
+
+def test_disk_backend():
+    with tempfile.TemporaryDirectory() as directory:
+        checkBackend(cache.DiskBackend(os.path.join(directory, 'cache')))
+        checkPurge(cache.DiskBackend(os.path.join(directory, 'purge')))
+        assert len(os.listdir(os.path.join(directory, 'purge'))) == 2
+
+
+def test_sqlite_backend():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'cache.sqlite')
+        checkBackend(cache.SQLiteBackend(filename))
+        checkPurge(cache.SQLiteBackend(os.path.join(directory, 'purge.sqlite')))
+        # Another process (connection) sees the same entries
+        cache.Cache('shared', backend=cache.SQLiteBackend(filename)).set('k', time.time())
+        assert cache.Cache('shared', backend=cache.SQLiteBackend(filename)).get('k') is not None
+
+
+def test_environment():
+    os.environ[cache.environmentVariable] = 'memory:5'
+    try:
+        assert cache.backendFromEnvironment().maxEntries == 5
+        os.environ[cache.environmentVariable] = 'sqlite:/tmp/x.sqlite'
+        assert isinstance(cache.backendFromEnvironment(), cache.SQLiteBackend)
+    finally:
+        del os.environ[cache.environmentVariable]
+    assert isinstance(cache.backendFromEnvironment(), cache.MemoryBackend)
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
@@ -0,0 +1,97 @@
+import sys
+import os
+import time
+import logging
+import importlib
+
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, include)
+
+from bs4 import SoupStrainer  # noqa: E402
+
+import htmlsoup  # noqa: E402
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+page = """<html><head><script>document.write("<h2>script</h2>");</script></head><body>
+<nav><ul><li><a href="/">Start</a></li></ul></nav>
+<h2>Speiseplan</h2>
+<div class="et_pb_toggle et_pb_toggle_item"><h2>Montag</h2><p><strong>Menü:</strong> Suppe</p></div>
+<div class="et_pb_toggle_itemx">not this one</div>
+<p id="message">Bedienstete + 25%</p>
+<footer><p>Impressum</p></footer>
+</body></html>"""
+
+
+def test_strained():
+    document = htmlsoup.parse(page, SoupStrainer("h2"), htmlsoup.withClass("div", "et_pb_toggle_item"),
+                              SoupStrainer(id="message"))
+    assert [h2.text for h2 in document.find_all("h2")] == ["Speiseplan", "Montag"]
+    assert len(document.find_all("div")) == 1
+    assert document.find("p", {"id": "message"}).text == "Bedienstete + 25%"
+    assert not document.find("footer") and not document.find("script")
+
+
+def test_full_tree():
+    htmlsoup.strained = False
+    try:
+        document = htmlsoup.parse(page, SoupStrainer("h2"))
+        assert document.find("footer") and len(document.find_all("div")) == 2
+    finally:
+        htmlsoup.strained = True
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+# Parsers that use htmlsoup.parse()
+htmlParsers = ('hamburg', 'mannheim', 'stuttgart', 'eppelheim')
+modes = (('html.parser', False), ('lxml', True))
+
+
+def benchmark(directory, parserNames=htmlParsers):
+    """Generate the feeds of all canteens from responses that were recorded with
+    'updateFeeds.py -record directory', with the old html.parser full tree and with
+    lxml and strainers. Prints the time spent parsing and checks that the feeds are the same"""
+    import runreport
+    import webclient
+    import cassette
+    webclient.setCassette('replay', directory)
+    for parserName in parserNames:
+        parser = importlib.import_module(parserName).getParser("http://localhost/{metaOrFeed}/{mensaReference}.xml")
+        feedMethod = getattr(parser, 'feed', None) or parser.feed_all
+        feeds = {}
+        for features, strained in modes:
+            htmlsoup.features, htmlsoup.strained = features, strained
+            webclient.parsedResults.clear()
+            record = runreport.Record()
+            feeds[features] = {}
+            started = time.perf_counter()
+            with runreport.recording(record):
+                for name in parser.canteens:
+                    try:
+                        feeds[features][name] = feedMethod(name)
+                    except cassette.CassetteMissError:
+                        pass
+            print(f"{parserName:10} {features:12} {len(feeds[features]):3} canteens  "
+                  f"parse {record.seconds['parse']:7.3f}s  total {time.perf_counter() - started:7.3f}s")
+        different = [name for name in feeds['lxml'] if feeds['lxml'][name] != feeds['html.parser'].get(name)]
+        if different:
+            print(f"{parserName:10} different feeds: {', '.join(different)}")
+    htmlsoup.features, htmlsoup.strained = modes[-1]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
+    if len(sys.argv) > 1:
+        # Benchmark: python tests/test_htmlsoup.py CASSETTE_DIRECTORY [parser ...]
+        benchmark(sys.argv[1], sys.argv[2:] or htmlParsers)
@@ -0,0 +1,76 @@
+import sys
+import os
+import logging
+import subprocess
+
+include = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+heavyModules = ('requests', 'urllib3', 'lxml', 'bs4', 'pyopenmensa')
+parserModules = ('hamburg', 'eppelheim', 'heidelberg', 'mannheim', 'stuttgart', 'ulm')
+
+
+def importTimes(code):
+    """Run code with python -X importtime.
+    Returns {module name: cumulative import time in microseconds}"""
+    env = dict(os.environ, PUBLIC_URL="http://127.0.0.1/")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=include, env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def loadedModules(code):
+    """Run code in a new interpreter, returns the names of all loaded modules"""
+    env = dict(os.environ, PUBLIC_URL="http://127.0.0.1/")
+    result = subprocess.run([sys.executable, '-c', code + '\nimport sys\nprint("\\n".join(sys.modules))'],
+                            cwd=include, env=env, capture_output=True, text=True, check=True)
+    return result.stdout.splitlines()
+
+
+def loaded(modules, packages):
+    return sorted(name for name in modules if name.split('.')[0] in packages)
+
+
+def test_updatefeeds_import():
+    times = importTimes('import updateFeeds')
+    assert not loaded(times, heavyModules + parserModules), loaded(times, heavyModules + parserModules)
+
+
+def test_wsgi_import():
+    times = importTimes('import mensahd.wsgi')
+    assert not loaded(times, heavyModules + parserModules), loaded(times, heavyModules + parserModules)
+
+
+def test_wsgi_loads_one_parser():
+    # importlib.import_module() itself does not show up in -X importtime, check sys.modules instead
+    modules = loadedModules('import mensahd.wsgi\nmensahd.wsgi.ulm.canteens')
+    assert loaded(modules, parserModules) == ['ulm'], loaded(modules, parserModules)
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
+    # Benchmark: the slowest imports of a single parser run
+    parserName = sys.argv[1] if len(sys.argv) > 1 else 'ulm'
+    times = importTimes(f'import updateFeeds\nimport {parserName}')
+    print(f"\nSlowest imports for 'updateFeeds -parser {parserName}' (cumulative ms):")
+    for name, microseconds in sorted(times.items(), key=lambda item: -item[1])[:15]:
+        print(f"{microseconds / 1000:8.1f} {name}")
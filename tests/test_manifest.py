@@ -0,0 +1,127 @@
+import sys
+import os
+import json
+import logging
+import tempfile
+
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, include)
+
+from manifest import Manifest, sha256  # noqa: E402
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+
+def writeFile(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='utf8') as f:
+        f.write(content)
+
+
+def test_unchanged():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        filename = os.path.join(directory, 'feed', 'a.xml')
+        manifest = Manifest(directory, root=root)
+        assert not manifest.unchanged(filename, sha256('a'))
+
+        writeFile(filename, 'a')
+        manifest.record(filename, sha256('a'))
+        assert manifest.unchanged(filename, sha256('a'))
+        assert not manifest.unchanged(filename, sha256('b'))
+        assert manifest.changed == [filename]
+        assert manifest.save()
+
+        manifest = Manifest(directory, root=root)
+        assert manifest.outputs() == ['feed/a.xml']
+        assert manifest.unchanged(filename, sha256('a'))
+        # The hash is only trusted while the file exists
+        os.remove(filename)
+        assert not manifest.unchanged(filename, sha256('a'))
+
+
+def test_unknown_file():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        filename = os.path.join(directory, 'meta', 'b.xml')
+        writeFile(filename, 'b')
+        manifest = Manifest(directory, root=root)
+        # A file that is not in the manifest yet is compared with the file on disk
+        assert manifest.unchanged(filename, sha256('b'))
+        assert manifest.outputs() == ['meta/b.xml']
+        assert manifest.changed == []
+
+
+def test_deleted_file():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        manifest = Manifest(directory, root=root)
+        for name in ('a', 'b'):
+            filename = os.path.join(directory, 'feed', f'{name}.xml')
+            writeFile(filename, name)
+            manifest.record(filename, sha256(name))
+        manifest.save()
+
+        os.remove(os.path.join(directory, 'feed', 'b.xml'))
+        manifest = Manifest(directory, root=root)
+        assert manifest.outputs() == ['feed/a.xml']
+        # The entry is removed from the manifest
+        assert manifest.save()
+        assert 'feed/b.xml' not in Manifest(directory, root=root).files
+
+
+def test_save_only_changes():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        filename = os.path.join(directory, 'feed', 'a.xml')
+        writeFile(filename, 'a')
+        manifest = Manifest(directory, root=root)
+        manifest.record(filename, sha256('a'))
+        manifest.save()
+        with open(manifest.filename, 'rb') as f:
+            saved = f.read()
+        generated = manifest.lastGenerated(keys=['feed/a.xml'])
+
+        # The same content again: the manifest is neither written nor listed as changed
+        manifest = Manifest(directory, root=root)
+        assert manifest.unchanged(filename, sha256('a'))
+        assert not manifest.save()
+        assert manifest.changed == []
+        with open(manifest.filename, 'rb') as f:
+            assert f.read() == saved
+        # The time of the check is kept in the state file
+        with open(manifest.stateFile, 'r', encoding='utf8') as f:
+            assert 'feed/a.xml' in json.load(f)['checked']
+        assert Manifest(directory, root=root).lastGenerated(keys=['feed/a.xml']) >= generated
+
+
+def test_last_generated():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        manifest = Manifest(directory, root=root)
+        manifest.files = {'feed/p_a.xml': {'sha256': '', 'time': 100},
+                          'feed/p_b.xml': {'sha256': '', 'time': 50},
+                          'feed/q_a.xml': {'sha256': '', 'time': 10}}
+        manifest.checked = {'feed/p_b.xml': 200}
+        assert manifest.lastGenerated(keys=['feed/p_a.xml', 'feed/p_b.xml']) == 100
+        assert manifest.lastGenerated(prefixes=('feed/q_', )) == 10
+        # Files that were never generated are the most outdated
+        assert manifest.lastGenerated(keys=['feed/p_c.xml', 'today/p_c.xml']) == 0
+        # Only the kinds of files that the parser writes count
+        assert manifest.lastGenerated(keys=['feed/p_a.xml', 'today/p_a.xml']) == 100
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
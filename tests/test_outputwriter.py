@@ -0,0 +1,96 @@
+import sys
+import os
+import logging
+import tempfile
+
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, include)
+
+from manifest import Manifest  # noqa: E402
+from outputwriter import OutputWriter  # noqa: E402
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+
+def readFile(filename):
+    with open(filename, 'r', encoding='utf8') as f:
+        return f.read()
+
+
+def stagingDirectories(root):
+    return [name for name in os.listdir(root) if name.startswith('.staging-')]
+
+
+def test_commit():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        filename = os.path.join(directory, 'feed', 'a.xml')
+        manifest = Manifest(directory, root=root)
+        committed = []
+        writer = OutputWriter(manifest)
+        assert writer.write(filename, '<a/>', onCommit=lambda: committed.append(filename))
+        # Staged next to the output directory, nothing is in place before commit()
+        assert not os.path.exists(filename) and len(stagingDirectories(root)) == 1
+        assert committed == []
+        assert writer.commit() == 1
+        assert readFile(filename) == '<a/>' and committed == [filename]
+        assert stagingDirectories(root) == []
+        assert manifest.changed == [filename]
+
+        # Unchanged content is not staged, onCommit() is called right away
+        writer = OutputWriter(manifest)
+        assert not writer.write(filename, '<a/>', onCommit=lambda: committed.append('again'))
+        assert committed == [filename, 'again']
+        assert writer.commit() == 0
+        assert stagingDirectories(root) == []
+
+
+def test_discard():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        filename = os.path.join(directory, 'feed', 'a.xml')
+        manifest = Manifest(directory, root=root)
+        writer = OutputWriter(manifest)
+        writer.write(filename, '<old/>')
+        writer.commit()
+
+        committed = []
+        writer = OutputWriter(manifest)
+        writer.write(filename, '<new/>', onCommit=lambda: committed.append(filename))
+        writer.discard()
+        assert readFile(filename) == '<old/>' and committed == []
+        assert stagingDirectories(root) == []
+        assert writer.commit() == 0
+
+
+def test_closed_manifest():
+    with tempfile.TemporaryDirectory() as root:
+        directory = os.path.join(root, 'docs')
+        filename = os.path.join(directory, 'meta', 'a.xml')
+        manifest = Manifest(directory, root=root)
+        committed = []
+        writer = OutputWriter(manifest)
+        writer.write(filename, '<a/>', onCommit=lambda: committed.append(filename))
+        # e.g. a parser that is still running after Control-C, when the manifest is saved
+        manifest.close()
+        manifest.save()
+        assert writer.commit() is None
+        assert not os.path.exists(filename) and committed == []
+        assert manifest.outputs() == []
+        assert stagingDirectories(root) == []
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
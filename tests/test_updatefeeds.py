@@ -0,0 +1,278 @@
+import sys
+import os
+import io
+import json
+import types
+import time
+import shutil
+import logging
+import tempfile
+import contextlib
+
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, include)
+
+import updateFeeds  # noqa: E402
+from manifest import Manifest  # noqa: E402
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+parserName = 'fakeparser'
+
+
+class FakeParser:
+    """Two canteens, the content of the files depends on the versions in state"""
+
+    def __init__(self, url_template, state, name=parserName):
+        self.url_template = url_template
+        self.state = state
+        self.name = name
+        self.canteens = {'a': 1, 'b': 2}
+        self.meta_sources = (state['metaSource'], )
+
+    def json(self):
+        return json.dumps(sorted(self.canteens))
+
+    def meta(self, name):
+        self.state['calls'].append(('meta', name))
+        return f'<meta name="{name}" version="{self.state["metaVersion"]}"/>'
+
+    def feed(self, name):
+        self.state['calls'].append(('feed', name))
+        time.sleep(self.state['feedSeconds'])
+        if name in self.state['interrupt']:
+            raise KeyboardInterrupt()
+        if name in self.state['broken']:
+            raise ValueError(f"{self.name}/{name} broken")
+        return f'<feed name="{name}" version="{self.state["feedVersion"]}"/>'
+
+    def prefetch(self, names, today=False):
+        self.state['prefetched'].append(list(names))
+        if self.state['prefetchError']:
+            raise self.state['prefetchError']
+
+
+@contextlib.contextmanager
+def sandbox(parserNames=(parserName, )):
+    """updateFeeds with only fake parsers, in a temporary repository"""
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'html'))
+    shutil.copy(os.path.join(updateFeeds.repoPath, 'html', 'index.html'), os.path.join(root, 'html', 'index.html'))
+    state = {'calls': [], 'loaded': 0, 'interrupt': (), 'broken': (), 'metaVersion': 1, 'feedVersion': 1,
+             'prefetched': [], 'prefetchError': None, 'feedSeconds': 0,
+             'metaSource': os.path.join(root, 'canteens.json'), 'root': root,
+             'docs': os.path.join(root, 'docs') + os.sep, 'changed': os.path.join(root, 'changed.txt')}
+    with open(state['metaSource'], 'w', encoding='utf8') as f:
+        f.write('{}')
+
+    def fakeModule(name):
+        module = types.ModuleType(name)
+        module.__file__ = state['metaSource']
+
+        def getParser(url_template):
+            state['loaded'] += 1
+            return FakeParser(url_template, state, name)
+
+        module.getParser = getParser
+        return module
+
+    previous = updateFeeds.repoPath, updateFeeds.allParsers
+    updateFeeds.repoPath = root
+    updateFeeds.allParsers = list(parserNames)
+    for name in parserNames:
+        sys.modules[name] = fakeModule(name)
+    try:
+        yield state
+    finally:
+        updateFeeds.repoPath, updateFeeds.allParsers = previous
+        for name in parserNames:
+            del sys.modules[name]
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run(state, **kwargs):
+    state['calls'] = []
+    args = dict(updateJson=True, updateMeta=True, updateFeed=True, updateIndex=True,
+                basePath=state['docs'], baseUrl='https://example.org/', changedList=state['changed'])
+    args.update(kwargs)
+    exitCode = updateFeeds.updateFeeds(**args)
+    with open(state['changed'], 'r', encoding='utf8') as f:
+        changed = sorted(os.path.relpath(line.strip(), state['docs']).replace(os.sep, '/') for line in f)
+    return exitCode, changed
+
+
+def readFile(filename):
+    with open(filename, 'r', encoding='utf8') as f:
+        return f.read()
+
+
+def test_index():
+    with sandbox() as state:
+        manifest = Manifest(state['docs'], root=state['root'])
+        for key in ('fakeparser.json', 'meta/fakeparser_a.xml', 'feed/fakeparser_a.xml'):
+            filename = os.path.join(state['docs'], key)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w', encoding='utf8') as f:
+                f.write(key)
+            manifest.record(filename, '')
+        assert updateFeeds.generateIndexHtml('https://example.org/', state['docs'], manifest)
+        index = readFile(os.path.join(state['docs'], 'index.html'))
+        for key in ('fakeparser.json', 'meta/fakeparser_a.xml', 'feed/fakeparser_a.xml'):
+            assert f'href="https://example.org/{key}"' in index
+        # Rendered again only if the files or the errors change
+        assert not updateFeeds.generateIndexHtml('https://example.org/', state['docs'], manifest)
+        assert updateFeeds.generateIndexHtml('https://example.org/', state['docs'], manifest, errors=['broken'])
+        assert 'broken' in readFile(os.path.join(state['docs'], 'index.html'))
+        # A deleted file is no longer listed
+        os.remove(os.path.join(state['docs'], 'meta', 'fakeparser_a.xml'))
+        assert updateFeeds.generateIndexHtml('https://example.org/', state['docs'], manifest, errors=['broken'])
+        assert 'meta/fakeparser_a.xml' not in readFile(os.path.join(state['docs'], 'index.html'))
+
+
+def test_changed_files():
+    with sandbox() as state:
+        feeds = ['feed/fakeparser_a.xml', 'feed/fakeparser_b.xml']
+        metas = ['meta/fakeparser_a.xml', 'meta/fakeparser_b.xml']
+        assert run(state) == (0, sorted(['.manifest', 'fakeparser.json', 'index.html', *feeds, *metas]))
+
+        # Nothing changed: no file is written, not even the manifest, and meta is not rendered
+        assert run(state) == (0, [])
+        assert sorted(state['calls']) == [('feed', 'a'), ('feed', 'b')]
+
+        state['feedVersion'] = 2
+        assert run(state) == (0, ['.manifest', *feeds])
+        assert 'version="2"' in readFile(os.path.join(state['docs'], feeds[0]))
+
+
+def test_meta_inputs():
+    with sandbox() as state:
+        run(state)
+        # Only meta files requested and their inputs did not change: the parser is not even loaded
+        loaded = state['loaded']
+        assert run(state, updateJson=False, updateFeed=False, updateIndex=False) == (0, [])
+        assert state['loaded'] == loaded
+
+        with open(state['metaSource'], 'w', encoding='utf8') as f:
+            f.write('{"changed": true}')
+        state['metaVersion'] = 2
+        exitCode, changed = run(state, updateJson=False, updateFeed=False, updateIndex=False)
+        assert sorted(state['calls']) == [('meta', 'a'), ('meta', 'b')]
+        assert changed == ['.manifest', 'meta/fakeparser_a.xml', 'meta/fakeparser_b.xml']
+
+
+def test_interrupt():
+    with sandbox() as state:
+        run(state)
+        with open(state['metaSource'], 'w', encoding='utf8') as f:
+            f.write('{"changed": true}')
+        state['metaVersion'] = 2
+        state['interrupt'] = ('b', )
+        # Control-C: the staged files of the parser are discarded, also the meta files
+        assert run(state, updateJson=False, updateIndex=False)[0] == 130
+        assert 'version="1"' in readFile(os.path.join(state['docs'], 'meta', 'fakeparser_a.xml'))
+
+        # The next run must not take the old meta files for up to date
+        state['interrupt'] = ()
+        exitCode, changed = run(state, updateJson=False, updateFeed=False, updateIndex=False)
+        assert ('meta', 'a') in state['calls']
+        assert 'version="2"' in readFile(os.path.join(state['docs'], 'meta', 'fakeparser_a.xml'))
+
+
+def test_budget():
+    with sandbox() as state:
+        run(state)
+        manifest = Manifest(state['docs'], root=state['root'])
+        # Canteen b was generated long ago
+        manifest.files['feed/fakeparser_b.xml']['time'] = 1
+        manifest.checked['feed/fakeparser_b.xml'] = 1
+        manifest.modified = True
+        manifest.save()
+
+        run(state, budget=3600, updateJson=False, updateMeta=False, updateIndex=False)
+        assert state['calls'] == [('feed', 'b'), ('feed', 'a')]
+        run(state, budget=3600, updateJson=False, updateMeta=False, updateIndex=False)
+        assert state['calls'] == [('feed', 'a'), ('feed', 'b')]
+
+
+def test_prefetch_error():
+    with sandbox() as state:
+        state['prefetchError'] = ValueError('broken source')
+        # The prefetch is only an optimisation, the canteens are still written
+        exitCode, changed = run(state, updateJson=False, updateMeta=False, updateIndex=False)
+        assert state['prefetched'] == [['a', 'b']]
+        assert exitCode == 0
+        assert changed == ['.manifest', 'feed/fakeparser_a.xml', 'feed/fakeparser_b.xml']
+
+
+def test_report():
+    with sandbox() as state:
+        state['feedSeconds'] = 0.3
+        reportFile = os.path.join(state['root'], 'report.json')
+        run(state, updateJson=False, updateMeta=False, updateIndex=False, canteenJobs=2, reportFile=reportFile)
+        with open(reportFile, 'r', encoding='utf8') as f:
+            parser = json.load(f)['parsers'][parserName]
+        # The canteens ran at the same time, the parser took less than the sum of the canteens
+        assert sum(canteen['wall'] for canteen in parser['canteens'].values()) >= 0.6
+        assert 0.3 <= parser['wall'] < 0.5
+
+
+def test_parallel_log():
+    parserNames = (parserName, 'otherparser')
+    with sandbox(parserNames) as state:
+        state['broken'] = ('a', 'b')
+        state['feedSeconds'] = 0.05
+        logFile = io.StringIO()
+        previous, updateFeeds.log_file = updateFeeds.log_file, logFile
+        try:
+            run(state, jobs=2, canteenJobs=2)
+        finally:
+            updateFeeds.log_file = previous
+
+        # The parsers and their canteens ran at the same time, but each parser has one block in the log
+        blocks = {}
+        current = None
+        for line in logFile.getvalue().splitlines():
+            if line.startswith('🗳️ '):
+                current = line[len('🗳️ '):]
+                assert current not in blocks, f"{current} has two blocks"
+                blocks[current] = []
+            elif line.startswith(' - 📄 index.html'):
+                current = None
+            elif current:
+                blocks[current].append(line)
+        assert list(blocks) == list(parserNames)
+        for name, lines in blocks.items():
+            text = '\n'.join(lines)
+            for other in parserNames:
+                if other != name:
+                    assert other not in text, f"{other} in the block of {name}"
+            for canteen in ('a', 'b'):
+                assert f'meta/{name}_{canteen}.xml' in text
+                assert f'ValueError: {name}/{canteen} broken' in text
+
+        # The errors on the status page are grouped per parser, each with its own traceback
+        index = readFile(os.path.join(state['docs'], 'index.html'))
+        status = index[index.index('<pre>') + len('<pre>'):index.index('</pre>')]
+        headings = []
+        for line in status.splitlines():
+            if line.endswith(':') and '/' in line and not line.startswith(' '):
+                headings.append(line)
+            elif line.startswith('ValueError: '):
+                assert line == f'ValueError: {headings[-1][:-1]} broken', line
+        assert headings == [f'{name}/{canteen}:' for name in parserNames for canteen in ('a', 'b')]
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
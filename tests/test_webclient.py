@@ -0,0 +1,341 @@
+import sys
+import os
+import gzip
+import time
+import types
+import logging
+import tempfile
+import threading
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+
+include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, include)
+
+import webclient  # noqa: E402
+import cassette  # noqa: E402
+import runreport  # noqa: E402
+import cache  # noqa: E402
+import deadline  # noqa: E402
+
+isPyIdle = "idlelib" in sys.modules
+endVT = "" if isPyIdle else "\033[0m"
+greenVT = "" if isPyIdle else "\033[1;32m"
+greenOk = f"{greenVT}Ok{endVT}"
+
+
+class CountingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    clients = []
+
+    def do_GET(self):
+        CountingHandler.requests.append(('GET', self.path, None))
+        CountingHandler.clients.append((self.client_address, self.headers['User-Agent']))
+        self.reply(self.path.encode('utf8'))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        CountingHandler.requests.append(('POST', self.path, body))
+        self.reply(body)
+
+    def reply(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def startServer(handler=CountingHandler):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_request_cache():
+    server, baseUrl = startServer()
+    CountingHandler.requests = []
+    try:
+        with webclient.requestCache():
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                texts = list(executor.map(lambda i: webclient.get(f"{baseUrl}/a").text, range(8)))
+            assert texts == ['/a'] * 8
+            assert webclient.post(f"{baseUrl}/b", data="x=1").text == "x=1"
+            assert webclient.post(f"{baseUrl}/b", data="x=1").text == "x=1"
+            assert webclient.post(f"{baseUrl}/b", data="x=2").text == "x=2"
+        assert len(CountingHandler.requests) == 3, CountingHandler.requests
+
+        # Outside of the context every call is sent
+        webclient.get(f"{baseUrl}/a")
+        webclient.get(f"{baseUrl}/a")
+        assert len(CountingHandler.requests) == 5
+    finally:
+        server.shutdown()
+
+
+def test_connection_pool():
+    server, baseUrl = startServer()
+    CountingHandler.clients = []
+    try:
+        for _ in range(3):
+            webclient.get(f"{baseUrl}/pool")
+        # All requests were sent over the same connection with the default user agent
+        assert len(set(CountingHandler.clients)) == 1, CountingHandler.clients
+        assert CountingHandler.clients[0][1] == webclient.userAgent()
+        assert webclient.get(f"{baseUrl}/pool", headers={'User-Agent': 'Mozilla/5.0'}).ok
+        assert CountingHandler.clients[-1][1] == 'Mozilla/5.0'
+    finally:
+        server.shutdown()
+
+
+class ETagHandler(CountingHandler):
+    body = b'{"weeks": []}'
+
+    def do_GET(self):
+        CountingHandler.requests.append(('GET', self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+
+
+def test_http_cache():
+    server, baseUrl = startServer(ETagHandler)
+    CountingHandler.requests = []
+    parseCalls = []
+
+    def parse(response):
+        parseCalls.append(response.url)
+        return response.json()
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            webclient.setCacheDirectory(directory)
+            first = webclient.get(f"{baseUrl}/plan.json")
+            second = webclient.get(f"{baseUrl}/plan.json")
+            assert first.content == second.content and second.status_code == 200
+            assert second.json() == {"weeks": []}
+            assert [request[2] for request in CountingHandler.requests] == [None, '"v1"']
+            # The unchanged body is only parsed once
+            assert webclient.parsed(first, parse, persistent=True) is webclient.parsed(second, parse, persistent=True)
+            assert len(parseCalls) == 1
+            # Not even in the next run, the result is kept on disk
+            webclient.parsedResults.clear()
+            assert webclient.parsed(second, parse, persistent=True) == {"weeks": []}
+            assert len(parseCalls) == 1
+            webclient.parsedResults.clear()
+            webclient.parsed(second, parse)
+            assert len(parseCalls) == 2
+
+            # After a change of the parser module the result on disk is not used
+            module = types.ModuleType('changedparser')
+            module.__file__ = os.path.join(directory, 'changedparser.py')
+            parse.__module__ = module.__name__
+            sys.modules[module.__name__] = module
+            for version in (1, 1, 2):
+                with open(module.__file__, 'w', encoding='utf8') as f:
+                    f.write(f'version = {version}\n')
+                os.utime(module.__file__, ns=(version, version))
+                webclient.parsedResults.clear()
+                webclient.parsed(second, parse, persistent=True)
+            assert len(parseCalls) == 4
+    finally:
+        sys.modules.pop('changedparser', None)
+        webclient.setCacheDirectory(None)
+        server.shutdown()
+
+
+def test_cassette():
+    server, baseUrl = startServer()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            webclient.setCassette('record', directory)
+            recorded = webclient.get(f"{baseUrl}/c", headers={'Authorization': 'Basic secret'})
+            webclient.post(f"{baseUrl}/d", data={'day': '1'})
+            server.shutdown()
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    assert b'secret' not in f.read()
+
+            webclient.setCassette('replay', directory)
+            assert webclient.replaying()
+            replayed = webclient.get(f"{baseUrl}/c")
+            assert (replayed.status_code, replayed.text) == (recorded.status_code, recorded.text)
+            assert webclient.post(f"{baseUrl}/d", data={'day': '1'}).text == "day=1"
+            try:
+                webclient.get(f"{baseUrl}/not-recorded")
+                raise AssertionError("CassetteMissError expected")
+            except cassette.CassetteMissError:
+                pass
+    finally:
+        webclient.setCassette(None, None)
+        server.shutdown()
+
+
+class FlakyHandler(CountingHandler):
+    failures = {}
+
+    def do_GET(self):
+        CountingHandler.requests.append(('GET', self.path, None))
+        remaining = FlakyHandler.failures.get(self.path, 0)
+        if remaining:
+            FlakyHandler.failures[self.path] = remaining - 1
+            self.reply(b'unavailable', status=503)
+        else:
+            self.reply(self.path.encode('utf8'))
+
+
+def test_retry_and_circuit_breaker():
+    server, baseUrl = startServer(FlakyHandler)
+    CountingHandler.requests = []
+    backoff = webclient.retryBackoffSeconds
+    webclient.retryBackoffSeconds = 0.01
+    webclient.setCircuitBreaker(2, None)
+    try:
+        # A transient 503 is retried
+        FlakyHandler.failures = {'/flaky': 1}
+        assert webclient.get(f"{baseUrl}/flaky").text == '/flaky'
+        assert len(CountingHandler.requests) == 2
+
+        # After two failed requests the host is not contacted anymore
+        FlakyHandler.failures = {'/down': 100}
+        assert webclient.get(f"{baseUrl}/down").status_code == 503
+        assert webclient.get(f"{baseUrl}/down").status_code == 503
+        assert len(CountingHandler.requests) == 2 + 2 * (webclient.maxRetries + 1)
+        try:
+            webclient.get(f"{baseUrl}/flaky")
+            raise AssertionError("CircuitOpenError expected")
+        except webclient.CircuitOpenError:
+            pass
+        assert len(CountingHandler.requests) == 2 + 2 * (webclient.maxRetries + 1)
+    finally:
+        webclient.retryBackoffSeconds = backoff
+        webclient.setCircuitBreaker(3, 300)
+        server.shutdown()
+
+
+class SlowHandler(CountingHandler):
+    def do_GET(self):
+        time.sleep(0.3)
+        super().do_GET()
+
+
+def test_fetch_all():
+    server, baseUrl = startServer(SlowHandler)
+    CountingHandler.requests = []
+    try:
+        with webclient.requestCache(), runreport.recording() as record:
+            started = time.perf_counter()
+            responses = webclient.fetchAll([('GET', f"{baseUrl}/day/{i}", {}) for i in range(4)] +
+                                           [('POST', f"{baseUrl}/day", {'data': 'x=1'})])
+            assert time.perf_counter() - started < 1.0
+            assert [response.text for response in responses] == [f'/day/{i}' for i in range(4)] + ['x=1']
+            # The overlapping requests are timed once
+            assert record.requests == 5
+            assert record.seconds['fetch'] <= time.perf_counter() - started
+            # Answered from the request cache
+            assert webclient.get(f"{baseUrl}/day/3").text == '/day/3'
+        assert len(CountingHandler.requests) == 5
+    finally:
+        server.shutdown()
+
+
+def test_deadline():
+    server, baseUrl = startServer(SlowHandler)
+    try:
+        started = time.perf_counter()
+        with deadline.within(0.1):
+            try:
+                webclient.get(f"{baseUrl}/slow")
+                assert False, "DeadlineExceeded expected"
+            except deadline.DeadlineExceeded:
+                pass
+            # Requests of a batch share the deadline
+            responses = webclient.fetchAll([('GET', f"{baseUrl}/slow/{i}", {}) for i in range(3)])
+            assert all(isinstance(response, deadline.DeadlineExceeded) for response in responses), responses
+        assert time.perf_counter() - started < 0.5
+        with deadline.within(5):
+            # Running out of time is not counted as a failure of the host
+            assert webclient.get(f"{baseUrl}/slow").text == '/slow'
+            with deadline.within(60):
+                assert deadline.remaining() <= 5
+        assert deadline.remaining() is None
+    finally:
+        server.shutdown()
+
+
+class GzipHandler(CountingHandler):
+    body = b'<openmensa>' + b' ' * 100000 + b'</openmensa>'
+
+    def do_GET(self):
+        CountingHandler.requests.append(('GET', self.path, self.headers['Accept-Encoding']))
+        data = gzip.compress(self.body)
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def test_compression():
+    server, baseUrl = startServer(GzipHandler)
+    CountingHandler.requests = []
+    try:
+        with runreport.recording() as record:
+            assert webclient.get(f"{baseUrl}/sp.xml").content == GzipHandler.body
+        assert 'gzip' in CountingHandler.requests[0][2]
+        assert record.bytesDownloaded == len(GzipHandler.body)
+        assert record.bytesTransferred < len(GzipHandler.body) / 10
+    finally:
+        server.shutdown()
+
+
+def test_max_age():
+    server, baseUrl = startServer()
+    CountingHandler.requests = []
+    try:
+        cache.setBackend(cache.MemoryBackend())
+        for _ in range(3):
+            assert webclient.get(f"{baseUrl}/fresh", maxAge=60).text == '/fresh'
+        assert webclient.post(f"{baseUrl}/fresh", data="x=1", maxAge=60).text == 'x=1'
+        assert webclient.post(f"{baseUrl}/fresh", data="x=1", maxAge=60).text == 'x=1'
+        assert len(CountingHandler.requests) == 2, CountingHandler.requests
+        # Without maxAge the cache is not used
+        webclient.get(f"{baseUrl}/fresh")
+        assert len(CountingHandler.requests) == 3
+        assert cache.allStats()['responses']['hits'] >= 3
+
+        # Responses from the cache are recorded as well
+        with tempfile.TemporaryDirectory() as directory:
+            webclient.setCassette('record', directory)
+            webclient.get(f"{baseUrl}/fresh", maxAge=60)
+            webclient.setCassette('replay', directory)
+            assert webclient.get(f"{baseUrl}/fresh", maxAge=60).text == '/fresh'
+        assert len(CountingHandler.requests) == 3
+    finally:
+        webclient.setCassette(None, None)
+        cache.setBackend(None)
+        server.shutdown()
+
+
+def run_all():
+    for fname, f in list(globals().items()):
+        if fname.startswith('test_'):
+            print(f"{fname}()...")
+            f()
+            print(f"...{fname}() -> {greenOk}.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    run_all()
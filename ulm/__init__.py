@@ -6,17 +6,18 @@ import re
 import json
 import datetime
 import urllib
-import requests
 
 try:
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, weekdays_map
+    import webclient
+    import runreport
 except ModuleNotFoundError:
     import sys
     include = os.path.relpath(os.path.join(os.path.dirname(__file__), '..'))
     sys.path.insert(0, include)
-    from version import __version__, useragentname, useragentcomment
     from util import StyledLazyBuilder, now_local, weekdays_map
+    import webclient
+    import runreport
 
 metaJson = os.path.join(os.path.dirname(__file__), "ulm.json")
 
@@ -32,6 +33,8 @@ remove_uppercase_regex = re.compile(
     '[A-Z]{3,}')  # Strip uppercase from meal_raw
 
 roles = ('student', 'employee', 'other')
+# Seconds that a downloaded menu is reused, see webclient.get()
+cacheSeconds = 15 * 60
 weekdays = ('Monday', 'Tuesday', 'Wednesday',
             'Thursday', 'Friday', 'Saturday', 'Sunday')
 default_category = "Essen"
@@ -68,26 +71,42 @@ legend = {
 }
 
 headers = {
-    'User-Agent': f'{useragentname}/{__version__} (+{useragentcomment}) {requests.utils.default_user_agent()}',
     'Accept': 'application/json',
     'Accept-Language': 'de-De,de'
 }
 
 
-def _from_json(canteen, url, place):
+def _parseJson(response):
+    with runreport.stage('parse'):
+        return response.json()
 
+
+def _allowedUrl(url):
     if not url.startswith("http://") and not url.startswith("https://"):
         raise RuntimeError(f"url is not an allowed URL: '{url}'")
-    result = requests.get(url, headers=headers)
-    if result.status_code == 404:
-        logging.warning(f"{result} for {url}. Setting week 'closed'")
-        # Set 7 days closed
+    return url
+
+
+def _setWeekClosed(canteens):
+    # Set 7 days closed
+    for canteen in canteens:
         for i in range(7):
             canteen.setDayClosed((now_local().date() + datetime.timedelta(i)))
-        return
+
+
+def _from_json(canteens, url):
+    """Add the meals of url to the canteens, a dict {place: builder}.
+    The file is downloaded and decoded once for all places.
+    Returns the errors of the places that could not be added, {place: exception}"""
+    failed = {}
+    result = webclient.get(_allowedUrl(url), headers=headers, maxAge=cacheSeconds)
+    if result.status_code == 404:
+        logging.warning(f"{result} for {url}. Setting week 'closed'")
+        _setWeekClosed(canteens.values())
+        return failed
 
     try:
-        data = result.json()
+        data = webclient.parsed(result, _parseJson, sizeFactor=4, persistent=True)
     except json.decoder.JSONDecodeError as e:
         logging.error(f"JSONDecodeError: {e}")
         data = None
@@ -95,10 +114,8 @@ def _from_json(canteen, url, place):
     if not data or 'weeks' not in data or not data['weeks']:
         logging.warning(
             f'Empty/malformed json file, setting week to "closed" ({url})')
-        # Set 7 days closed
-        for i in range(7):
-            canteen.setDayClosed((now_local().date() + datetime.timedelta(i)))
-        return
+        _setWeekClosed(canteens.values())
+        return failed
 
     for week in data['weeks']:
         for day in week['days']:
@@ -113,78 +130,94 @@ def _from_json(canteen, url, place):
                 date = (today + datetime.timedelta(days=till_next)
                         ).strftime('%Y-%m-%d')
 
-            if place not in day:
-                continue
-
-            mensa = day[place]
-
-            if 'open' in mensa and not mensa['open']:
-                canteen.setDayClosed(date)
-                continue
+            for place, canteen in canteens.items():
+                if place in day and place not in failed:
+                    try:
+                        _addDay(canteen, date, day[place])
+                    except Exception as e:
+                        # The other places of the file are still added
+                        failed[place] = e
+    return failed
 
-            if 'meals' not in mensa:
-                continue
 
-            for meal in mensa['meals']:
-                name = remove_notes_regex.sub('', meal['meal']).strip(' /')
+def _addDay(canteen, date, mensa):
+    if 'open' in mensa and not mensa['open']:
+        canteen.setDayClosed(date)
+        return
 
-                # Prices
-                if 'price' in meal and meal['price']:
-                    prices = price_roles_regex.findall(meal['price'])
-                    if len(prices) > len(roles):
-                        prices = prices[0:len(roles)]
-                    if not prices and price_single_regex.search(meal['price']):
-                        prices = [price_single_regex.search(
-                            meal['price']).group('price')]
-                        if len(prices) > len(roles):
-                            prices = prices[0:len(roles)]
+    if 'meals' not in mensa:
+        return
 
-                else:
-                    prices = []
+    for meal in mensa['meals']:
+        name = remove_notes_regex.sub('', meal['meal']).strip(' /')
+
+        # Prices
+        if 'price' in meal and meal['price']:
+            prices = price_roles_regex.findall(meal['price'])
+            if len(prices) > len(roles):
+                prices = prices[0:len(roles)]
+            if not prices and price_single_regex.search(meal['price']):
+                prices = [price_single_regex.search(
+                    meal['price']).group('price')]
+                if len(prices) > len(roles):
+                    prices = prices[0:len(roles)]
+
+        else:
+            prices = []
+
+        # Get the notes from the meal_raw field
+        notes = []
+        if 'meal_raw' in meal:
+            try:
+                # Remove duplicate info from meal_raw
+                raw = remove_uppercase_regex.sub(
+                    '', meal['meal_raw'].strip()).strip(' /')
+                raw_parts = raw.split()
+                name_parts = name.split()
+                for x in name_parts:
+                    if x in raw_parts:
+                        raw_parts.remove(x)
+                raw = ' '.join(raw_parts)
+
+                # Split at whitespace, round brackets and comma
+                raw = raw.replace('(', ' ').replace(
+                    ')', ' ').replace(',', ' ').replace('\uf02f', '')
+                tags = [s.strip() for s in raw.split() if s.strip()]
+
+                # Convert via legend
+                for tag in set(tags):
+                    if tag in legend:
+                        notes.append(legend[tag])
+                    else:
+                        notes.append(tag)
+            except Exception as e:
+                # traceback.print_exc()
+                logging.warning("Could not generate notes: %r" % (e,))
+
+        if name:
+            canteen.addMeal(
+                date, meal['category'], name, notes, prices, roles)
+        else:
+            # No meal name -> use category as name and a default
+            # category
+            canteen.addMeal(date, default_category,
+                            meal['category'], notes, prices, roles)
 
-                # Get the notes from the meal_raw field
-                notes = []
-                if 'meal_raw' in meal:
-                    try:
-                        # Remove duplicate info from meal_raw
-                        raw = remove_uppercase_regex.sub(
-                            '', meal['meal_raw'].strip()).strip(' /')
-                        raw_parts = raw.split()
-                        name_parts = name.split()
-                        for x in name_parts:
-                            if x in raw_parts:
-                                raw_parts.remove(x)
-                        raw = ' '.join(raw_parts)
-
-                        # Split at whitespace, round brackets and comma
-                        raw = raw.replace('(', ' ').replace(
-                            ')', ' ').replace(',', ' ').replace('\uf02f', '')
-                        tags = [s.strip() for s in raw.split() if s.strip()]
-
-                        # Convert via legend
-                        for tag in set(tags):
-                            if tag in legend:
-                                notes.append(legend[tag])
-                            else:
-                                notes.append(tag)
-                    except Exception as e:
-                        # traceback.print_exc()
-                        logging.warning("Could not generate notes: %r" % (e,))
 
-                if name:
-                    canteen.addMeal(
-                        date, meal['category'], name, notes, prices, roles)
-                else:
-                    # No meal name -> use category as name and a default
-                    # category
-                    canteen.addMeal(date, default_category,
-                                    meal['category'], notes, prices, roles)
+def _parse_url(sourcepage, filename, place):
+    feed = _parse_group(sourcepage, filename, [place])[place]
+    if isinstance(feed, Exception):
+        raise feed
+    return feed
 
 
-def _parse_url(sourcepage, filename, place):
-    canteen = StyledLazyBuilder()
-    _from_json(canteen, sourcepage + filename, place)
-    return canteen.toXMLFeed()
+def _parse_group(sourcepage, filename, places):
+    """Feeds of all places that share the source file, {place: feed}.
+    A place that failed is returned as its exception"""
+    canteens = {place: StyledLazyBuilder() for place in places}
+    failed = _from_json(canteens, sourcepage + filename)
+    return {place: failed[place] if place in failed else canteen.toXMLFeed()
+            for place, canteen in canteens.items()}
 
 
 def _generateCanteenMeta(obj, name, url_template):
@@ -242,6 +275,8 @@ def _generateCanteenMeta(obj, name, url_template):
 
 
 class Parser:
+    meta_sources = (metaJson, metaTemplateFile)
+
     def __init__(self, url_template, sourceurl):
         self.url_template = url_template
         self.sourceurl = sourceurl
@@ -253,6 +288,8 @@ class Parser:
         for mensa in self.metaObj["mensen"]:
             self.xmlnames.append(mensa["xml"])
             self.canteens[mensa["xml"]] = (mensa["file"], mensa["filter"])
+        # Feeds from prefetch(), each one is used once by feed()
+        self.prefetched = {}
 
     def json(self):
         tmp = {}
@@ -264,7 +301,48 @@ class Parser:
     def meta(self, name):
         return _generateCanteenMeta(self.metaObj, name, self.url_template)
 
+    def feeds(self, names):
+        """Feeds of the canteens, {name: feed}. Canteens that share a source file are
+        built together from one download. A canteen that failed is returned as its exception"""
+        groups = {}
+        for name in names:
+            filename, place = self.canteens[name]
+            groups.setdefault(filename, {}).setdefault(place, []).append(name)
+        feeds = {}
+        for filename, places in groups.items():
+            try:
+                group = _parse_group(self.sourceurl, filename, places)
+            except Exception as e:
+                group = {place: e for place in places}
+            for place, feed in group.items():
+                for name in places[place]:
+                    feeds[name] = feed
+        return feeds
+
+    def prefetch(self, names, today=False):
+        """Download each source file once and build the feeds of all canteens that use it"""
+        if today:
+            # There is no feed_today, -today does not use the source files
+            return
+        names = [name for name in names if name in self.canteens]
+        urls = sorted({_allowedUrl(self.sourceurl + self.canteens[name][0]) for name in names})
+        webclient.fetchAll([('GET', url, {'headers': headers, 'maxAge': cacheSeconds}) for url in urls])
+        try:
+            feeds = self.feeds(names)
+        except Exception as e:
+            # feed() downloads the file again and reports the error per canteen
+            logging.debug(f"Prefetching failed: {e}")
+            return
+        for name, feed in feeds.items():
+            if isinstance(feed, Exception):
+                # feed() builds the canteen again and reports the error
+                logging.debug(f"Prefetching {name} failed: {feed}")
+            else:
+                self.prefetched[name] = feed
+
     def feed(self, name):
+        if name in self.prefetched:
+            return self.prefetched.pop(name)
         return _parse_url(
             self.sourceurl, self.canteens[name][0], self.canteens[name][1])
 
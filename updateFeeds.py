@@ -3,9 +3,21 @@ import sys
 import os
 import traceback
 import argparse
-import urllib
-import urllib3
+import urllib.error
 import string
+import json
+import time
+import threading
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import webclient
+import cache
+import runreport
+import deadline
+from manifest import Manifest, sha256
+from outputwriter import OutputWriter
 
 allParsers = ['hamburg', 'eppelheim',
               'heidelberg', 'mannheim', 'stuttgart', 'ulm']
@@ -13,44 +25,122 @@ allParsers = ['hamburg', 'eppelheim',
 repoPath = os.path.dirname(__file__)
 filenameTemplate = "{base}{{metaOrFeed}}/{parserName}_{{mensaReference}}.xml"
 baseRepo = "https://github.com/cvzi/mensahd/"
+# Time for all upstream requests of one canteen, see -deadline
+defaultCanteenSeconds = 10 * 60
 defaultBaseUrl = "https://cvzi.github.io/mensahd/"
 defaultBasePath = "docs/"
 
 
 log_file = None
+log_buffer = threading.local()
 greenOk = "Ok" if "idlelib" in sys.modules else "\033[1;32mOk\033[0m"
 redError = "Error" if "idlelib" in sys.modules else "\033[1;31m⚠️ Error\033[0m"
 
 
+def networkErrors():
+    """Exception types that indicate a network problem. urllib3 is only imported
+    by the parsers, so its errors can only occur if it was loaded"""
+    errors = (IOError, ConnectionError, urllib.error.URLError)
+    urllib3Exceptions = sys.modules.get('urllib3.exceptions')
+    if urllib3Exceptions:
+        errors += (urllib3Exceptions.HTTPError, )
+    return errors
+
+
 def log(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
+    entries = getattr(log_buffer, 'entries', None)
+    if entries is not None:
+        entries.append((sep.join(str(obj) for obj in objects) + end, file))
+        return
     print(*objects, sep=sep, end=end, file=file, flush=flush)
     if log_file and not log_file.closed:
         print(*objects, sep=sep, end=end, file=log_file, flush=flush)
 
 
-def generateIndexHtml(baseUrl, basePath, errors=None):
-    files = []
+@contextlib.contextmanager
+def capturedLog():
+    """Collect all log() calls of the current thread instead of printing them"""
+    previous = getattr(log_buffer, 'entries', None)
+    log_buffer.entries = []
+    try:
+        yield log_buffer.entries
+    finally:
+        log_buffer.entries = previous
+
+
+def replayLog(entries):
+    """Print log entries that were collected with capturedLog()"""
+    for text, file in entries:
+        log(text, end='', file=file, flush=True)
+
+
+def runCaptured(func, *args, **kwargs):
+    """Call func and collect its log output.
+    Returns (log entries, result, None) or (log entries, None, network error)"""
+    with capturedLog() as entries:
+        try:
+            return entries, func(*args, **kwargs), None
+        except networkErrors() as e:
+            return entries, None, e
+
+
+def runLive(func, *args, **kwargs):
+    """Same as runCaptured() but the log output is printed immediately"""
+    try:
+        return [], func(*args, **kwargs), None
+    except networkErrors() as e:
+        return [], None, e
+
+
+class TimeBudget:
+    """Wall clock limit for starting new work, remembers what had to be skipped"""
+
+    def __init__(self, seconds=None):
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.lock = threading.Lock()
+        self.skipped = []
+
+    def exhausted(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def skip(self, name):
+        with self.lock:
+            self.skipped.append(name)
+
 
-    for r, _, f in os.walk(os.path.join(repoPath, basePath)):
-        p = baseUrl + r[len(os.path.join(repoPath, basePath)):]
-        if p[-1] != '/':
-            p += '/'
-        for file in f:
-            if file.endswith(('.xml', '.json')):
-                files.append(f"{p}{file}")
+def outputKinds(updateMeta, updateFeed, updateToday):
+    """Names of the output directories whose age orders the work for -budget.
+    Meta files are skipped while their inputs are unchanged and keep their old
+    time, so they only count if no feeds are updated"""
+    if updateToday:
+        return ['today']
+    if updateFeed:
+        return ['feed', 'today']
+    return ['meta'] if updateMeta else []
 
+
+def generateIndexHtml(baseUrl, basePath, manifest, errors=None):
+    """Render index.html from the output files in the manifest.
+    Returns False if neither the files nor the errors changed since the last time"""
+    filename = os.path.join(repoPath, basePath, 'index.html')
     with open(os.path.join(repoPath, 'html/index.html'), 'r', encoding='utf8') as f:
-        template = string.Template(f.read())
+        templateText = f.read()
+
+    outputs = manifest.outputs()
+    digest = sha256(json.dumps([baseUrl, outputs, errors or [], templateText]))
+    if manifest.indexUpToDate(digest, filename):
+        return False
 
-    def sortKey(s):
-        parts = s[len(baseUrl):].split('/')
-        s = parts[-1].upper() + (parts[-2] if len(parts) > 1 else "")
-        return s
+    def sortKey(key):
+        parts = key.split('/')
+        return parts[-1].upper() + (parts[-2] if len(parts) > 1 else "")
 
+    files = [baseUrl + key for key in sorted(outputs, key=sortKey)]
+    template = string.Template(templateText)
     content = []
     first = True
 
-    for file in sorted(files, key=sortKey):
+    for file in files:
         if file.endswith('.json'):
             if not first:
                 content.append('</ul>')
@@ -74,112 +164,344 @@ def generateIndexHtml(baseUrl, basePath, errors=None):
     if errors:
         status += '\n<pre>' + '\n'.join(errors) + '</pre>'
 
-    with open(os.path.join(repoPath, basePath, 'index.html'), 'w', encoding='utf8') as f:
-        f.write(template.substitute(content=content, status=status))
-
-
-def updateFeeds(force=None,
-                updateJson=True,
-                updateMeta=True,
-                updateFeed=True,
-                updateToday=False,
-                updateIndex=True,
-                selectedParser='',
-                selectedMensa='',
-                baseUrl=defaultBaseUrl,
-                basePath=defaultBasePath):
+    content = template.substitute(content=content, status=status)
+    writer = OutputWriter(manifest)
+    writer.write(filename, content)
+    writer.commit()
+    manifest.recordIndex(digest)
+    return True
+
+
+def saveManifest(manifest, changedList=None):
+    """Store the manifest and write the paths of all changed files to changedList ('-' for stdout).
+    Parsers that are still running after Control-C can no longer move files into place"""
+    manifest.close()
+    manifest.save()
+    changed = [os.path.relpath(filename) for filename in manifest.changed]
+    log(f" - 📝 {len(changed)} changed files")
+    if changedList == '-':
+        for filename in changed:
+            print(filename)
+    elif changedList:
+        with open(changedList, 'w', encoding='utf8') as f:
+            f.writelines(f"{filename}\n" for filename in changed)
+
+
+def updateCanteen(parser,
+                  parserName,
+                  mensaReference,
+                  updateMeta,
+                  updateFeed,
+                  updateToday,
+                  basePath,
+                  manifest,
+                  writer,
+                  budget,
+                  report,
+                  metaInputs=None,
+                  canteenSeconds=None):
+    """Write the files of a single canteen, returns the list of errors. Network errors are raised"""
+    errors = []
 
+    if budget.exhausted():
+        budget.skip(f"{parserName}/{mensaReference}")
+        log(f"  - 🏫 {mensaReference}  ⏳ skipped")
+        return errors
+
+    log(f"  - 🏫 {mensaReference}")
+    record = runreport.Record()
+    report.add(parserName, record, canteen=mensaReference)
+    try:
+        with runreport.recording(record), deadline.within(canteenSeconds):
+            if updateMeta:
+                filename = filenameTemplate.format(base=basePath, parserName=parserName).format(
+                    metaOrFeed='meta', mensaReference=mensaReference)
+                log(f"    - 🈺 {filename}", end="", flush=True)
+                filename = os.path.join(repoPath, filename)
+                if metaInputs and manifest.metaUpToDate(parserName, metaInputs, parser.url_template, filename):
+                    log(f"  {greenOk} (unchanged)")
+                else:
+                    content = parser.meta(mensaReference)
+                    runreport.addOutput(content)
+                    recordMeta = None
+                    if metaInputs:
+                        # Only recorded when the file is in place, not if the run is interrupted
+                        recordMeta = functools.partial(
+                            manifest.recordMeta, parserName, metaInputs, parser.url_template, filename)
+                    writer.write(filename, content, onCommit=recordMeta)
+                    log(f"  {greenOk}")
+            if updateFeed or updateToday:
+                if updateToday:
+                    feedMethods = [feedMethod for feedMethod in [
+                        "feed_today"] if hasattr(parser, feedMethod)]
+                    if not feedMethods and not updateMeta:
+                        log("\033[F\033[K", end="")
+                else:
+                    feedMethods = [feedMethod for feedMethod in [
+                        "feed", "feed_today", "feed_all", "feed_full"] if hasattr(parser, feedMethod)]
+                for feedMethod in feedMethods:
+                    fileTitle = "today" if feedMethod == "feed_today" else "feed"
+                    filename = filenameTemplate.format(base=basePath, parserName=parserName).format(
+                        metaOrFeed=fileTitle, mensaReference=mensaReference)
+                    log(f"    - 🍱 {filename}", end="", flush=True)
+                    content = getattr(parser, feedMethod)(
+                        mensaReference)
+                    runreport.addOutput(content)
+                    writer.write(os.path.join(repoPath, filename), content)
+                    log(f"  {greenOk}")
+    except KeyboardInterrupt as e:
+        raise e
+    except networkErrors() as e:
+        raise e
+    except BaseException:
+        log(f"  {redError}")
+        log(traceback.format_exc(), end="", file=sys.stderr)
+        errors.append(f"{parserName}/{mensaReference}:")
+        errors.append(traceback.format_exc())
+
+    return errors
+
+
+def updateParser(parserName,
+                 updateJson,
+                 updateMeta,
+                 updateFeed,
+                 updateToday,
+                 selectedMensa,
+                 baseUrl,
+                 basePath,
+                 manifest,
+                 budget,
+                 report,
+                 canteenJobs=1,
+                 canteenSeconds=None):
+    """Run a single parser and write its files, returns the list of errors"""
     errors = []
 
-    for parserName in allParsers:
-        if not updateJson and not updateMeta and not updateFeed and not updateToday:
-            continue
-        if selectedParser and parserName != selectedParser:
-            continue
-        log(f"🗳️ {parserName}")
-        try:
+    urlTemplate = filenameTemplate.format(base=baseUrl, parserName=parserName)
+    if (updateMeta and not updateJson and not updateFeed and not updateToday and not selectedMensa and
+            manifest.allMetaUpToDate(parserName, urlTemplate)):
+        # Only meta files requested and none of their inputs changed, no need to load the parser
+        log(f"🗳️ {parserName}  {greenOk} (unchanged)")
+        return errors
+
+    if budget.exhausted():
+        budget.skip(parserName)
+        log(f"🗳️ {parserName}  ⏳ skipped")
+        return errors
+
+    log(f"🗳️ {parserName}")
+    record = runreport.Record()
+    report.add(parserName, record)
+    parserRecord = runreport.Record()
+    report.addParser(parserName, parserRecord)
+    # All files of this parser are moved into place together when the parser is done
+    writer = OutputWriter(manifest)
+    try:
+        with runreport.recording(record), deadline.within(canteenSeconds):
             module = importlib.import_module(parserName)
-            parser = module.getParser(filenameTemplate.format(
-                base=baseUrl, parserName=parserName))
+            parser = module.getParser(urlTemplate)
 
             if updateJson:
                 filename = os.path.join(basePath, f'{parserName}.json')
                 log(f" - 🐏 {filename}", end="", flush=True)
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
                 content = parser.json()
-                with open(os.path.join(repoPath, filename), 'w', encoding='utf8') as f:
-                    f.write(content)
+                runreport.addOutput(content)
+                writer.write(os.path.join(repoPath, filename), content)
                 log(f"  {greenOk}")
 
-            canteenCounter = 0
-            for mensaReference in parser.canteens:
-                if selectedMensa and selectedMensa != mensaReference:
-                    continue
-                log(f"  - 🏫 {mensaReference}")
-                try:
-                    if updateMeta:
-                        filename = filenameTemplate.format(base=basePath, parserName=parserName).format(
-                            metaOrFeed='meta', mensaReference=mensaReference)
-                        log(f"    - 🈺 {filename}", end="", flush=True)
-                        os.makedirs(os.path.dirname(filename), exist_ok=True)
-                        content = parser.meta(mensaReference)
-                        with open(os.path.join(repoPath, filename), 'w', encoding='utf8') as f:
-                            f.write(content)
-                        log(f"  {greenOk}")
-                    if updateFeed or updateToday:
-                        if updateToday:
-                            feedMethods = [feedMethod for feedMethod in [
-                                "feed_today"] if hasattr(parser, feedMethod)]
-                            if not feedMethods and not updateMeta:
-                                log("\033[F\033[K", end="")
-                        else:
-                            feedMethods = [feedMethod for feedMethod in [
-                                "feed", "feed_today", "feed_all", "feed_full"] if hasattr(parser, feedMethod)]
-                        for feedMethod in feedMethods:
-                            fileTitle = "today" if feedMethod == "feed_today" else "feed"
-                            filename = filenameTemplate.format(base=basePath, parserName=parserName).format(
-                                metaOrFeed=fileTitle, mensaReference=mensaReference)
-                            log(f"    - 🍱 {filename}", end="", flush=True)
-                            os.makedirs(os.path.dirname(
-                                filename), exist_ok=True)
-                            content = getattr(parser, feedMethod)(
-                                mensaReference)
-                            if type(content) is bytes:
-                                with open(os.path.join(repoPath, filename), 'wb') as f:
-                                    f.write(content)
-                            else:
-                                with open(os.path.join(repoPath, filename), 'w', encoding='utf8') as f:
-                                    f.write(content)
-                            log(f"  {greenOk}")
-                except KeyboardInterrupt as e:
-                    raise e
-                except (IOError, ConnectionError, urllib.error.URLError, urllib3.exceptions.HTTPError) as e:
-                    if canteenCounter == 0:
-                        # Assumption: this errors affects the whole parser, skip the whole parser
-                        raise e
-                    else:
-                        log(f"  {redError}")
-                        traceback.print_exc()
-                except BaseException:
-                    log(f"  {redError}")
-                    traceback.print_exc()
-                    errors.append(f"{parserName}/{mensaReference}:")
-                    errors.append(traceback.format_exc())
-                canteenCounter += 1
+        mensaReferences = [mensaReference for mensaReference in parser.canteens
+                           if not selectedMensa or selectedMensa == mensaReference]
+        if budget.deadline:
+            # Most outdated canteens first
+            kinds = outputKinds(updateMeta, updateFeed, updateToday)
+            mensaReferences.sort(key=lambda mensaReference: manifest.lastGenerated(
+                keys=[f"{kind}/{parserName}_{mensaReference}.xml" for kind in kinds]))
+        if (updateFeed or updateToday) and mensaReferences and hasattr(parser, 'prefetch'):
+            # Download the sources of all canteens at once, the canteens then read them from the request cache
+            try:
+                with runreport.recording(record), deadline.within(canteenSeconds):
+                    parser.prefetch(mensaReferences, today=updateToday and not updateFeed)
+            except Exception:
+                # Only an optimisation, the canteens download their sources themselves
+                log(" - prefetch failed, the canteens are downloaded one by one")
+                log(traceback.format_exc(), end="", file=sys.stderr)
+        # The meta files depend on the parser code and its static files, if any
+        metaInputs = None
+        if updateMeta and getattr(parser, 'meta_sources', None):
+            metaInputs = manifest.inputDigests(
+                [module.__file__, os.path.join(repoPath, 'util.py'), *parser.meta_sources])
+
+        canteenArgs = dict(updateMeta=updateMeta,
+                           updateFeed=updateFeed,
+                           updateToday=updateToday,
+                           basePath=basePath,
+                           manifest=manifest,
+                           writer=writer,
+                           budget=budget,
+                           report=report,
+                           metaInputs=metaInputs,
+                           canteenSeconds=canteenSeconds)
+
+        executor = None
+        if canteenJobs > 1 and len(mensaReferences) > 1:
+            # The number of requests per host is limited in webclient.hostSlot()
+            executor = ThreadPoolExecutor(max_workers=canteenJobs)
+            futures = [executor.submit(runCaptured, updateCanteen, parser, parserName, mensaReference, **canteenArgs)
+                       for mensaReference in mensaReferences]
+            outcomes = (future.result() for future in futures)
+        else:
+            outcomes = (runLive(updateCanteen, parser, parserName, mensaReference, **canteenArgs)
+                        for mensaReference in mensaReferences)
 
+        try:
+            for canteenCounter, (entries, canteenErrors, networkError) in enumerate(outcomes):
+                replayLog(entries)
+                if networkError is None:
+                    errors += canteenErrors
+                elif canteenCounter == 0:
+                    # Assumption: this errors affects the whole parser, skip the whole parser
+                    raise networkError
+                elif isinstance(networkError, (webclient.CircuitOpenError, deadline.DeadlineExceeded)):
+                    log(f"  {redError} {networkError}")
+                else:
+                    log(f"  {redError}")
+                    log("".join(traceback.format_exception(type(networkError), networkError,
+                                                           networkError.__traceback__)), end="", file=sys.stderr)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+
+        metaComplete = (metaInputs and not selectedMensa and
+                        not any(name.startswith(f"{parserName}/") for name in errors + budget.skipped))
+
+    except KeyboardInterrupt as e:
+        writer.discard()
+        raise e
+    except BaseException:
+        log(f"  {redError}")
+        errors.append(f"{parserName}:")
+        errors.append(traceback.format_exc())
+        log(traceback.format_exc(), end="", file=sys.stderr)
+        metaComplete = False
+
+    if writer.commit() is not None and metaComplete:
+        manifest.completeMeta(parserName)
+    parserRecord.finish()
+    return errors
+
+
+def runParsers(parserNames, parserArgs, errors, jobs=1):
+    """Call updateParser() for each parser and collect the errors. Returns 130 on Control-C"""
+    if jobs > 1 and len(parserNames) > 1:
+        # Run the parsers in a worker pool. The log output of each parser
+        # is collected and printed in one piece when the parser has finished
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        try:
+            futures = [executor.submit(runCaptured, updateParser, parserName, **parserArgs)
+                       for parserName in parserNames]
+            for future in futures:
+                entries, parserErrors, _ = future.result()
+                replayLog(entries)
+                errors += parserErrors
         except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
             log(" [Control-C]")
             return 130
-        except BaseException:
-            log(f"  {redError}")
-            errors.append(f"{parserName}:")
-            errors.append(traceback.format_exc())
-            traceback.print_exc()
+        executor.shutdown()
+    else:
+        for parserName in parserNames:
+            try:
+                errors += updateParser(parserName, **parserArgs)
+            except KeyboardInterrupt:
+                log(" [Control-C]")
+                return 130
+    return 0
+
+
+def updateFeeds(force=None,
+                updateJson=True,
+                updateMeta=True,
+                updateFeed=True,
+                updateToday=False,
+                updateIndex=True,
+                selectedParser='',
+                selectedMensa='',
+                baseUrl=defaultBaseUrl,
+                basePath=defaultBasePath,
+                jobs=1,
+                canteenJobs=1,
+                maxPerHost=webclient.defaultMaxPerHost,
+                changedList=None,
+                budget=None,
+                canteenSeconds=defaultCanteenSeconds,
+                reportFile=None,
+                httpCacheDirectory=None,
+                recordDirectory=None,
+                replayDirectory=None):
+
+    errors = []
+
+    webclient.setMaxPerHost(maxPerHost)
+    webclient.setCacheDirectory(httpCacheDirectory)
+    # A host that keeps failing is skipped for the rest of the run
+    webclient.setCircuitBreaker(webclient.failureThreshold, None)
+    if recordDirectory:
+        webclient.setCassette('record', recordDirectory)
+    elif replayDirectory:
+        webclient.setCassette('replay', replayDirectory)
+    manifest = Manifest(os.path.join(repoPath, basePath), root=repoPath)
+    # Only scans the output directory once, when there is no manifest next to existing files
+    manifest.seed()
+    budget = TimeBudget(budget)
+    report = runreport.Report()
+
+    parserNames = []
+    if updateJson or updateMeta or updateFeed or updateToday:
+        parserNames = [parserName for parserName in allParsers
+                       if not selectedParser or parserName == selectedParser]
+        if budget.deadline:
+            # Start with the parser that has the most outdated files
+            kinds = outputKinds(updateMeta, updateFeed, updateToday)
+            parserNames.sort(key=lambda parserName: manifest.lastGenerated(
+                prefixes=tuple(f"{kind}/{parserName}_" for kind in kinds)))
+
+    parserArgs = dict(updateJson=updateJson,
+                      updateMeta=updateMeta,
+                      updateFeed=updateFeed,
+                      updateToday=updateToday,
+                      selectedMensa=selectedMensa,
+                      baseUrl=baseUrl,
+                      basePath=basePath,
+                      manifest=manifest,
+                      budget=budget,
+                      report=report,
+                      canteenJobs=canteenJobs,
+                      canteenSeconds=canteenSeconds)
+
+    # Each distinct upstream request is only sent once during this run
+    with webclient.requestCache():
+        exitCode = runParsers(parserNames, parserArgs, errors, jobs)
+    if reportFile:
+        report.caches = cache.allStats()
+        report.save(reportFile)
+    if exitCode:
+        saveManifest(manifest, changedList)
+        return exitCode
+
+    if budget.skipped:
+        log(f"⏳ Time budget exhausted, skipped: {', '.join(budget.skipped)}")
+        errors.append("Skipped because the time budget was exhausted:")
+        errors.append(", ".join(budget.skipped))
 
     if updateIndex:
         log(" - 📄 index.html", end="", flush=True)
-        generateIndexHtml(baseUrl=baseUrl, basePath=basePath, errors=errors)
-        log(f"  {greenOk}")
+        if generateIndexHtml(baseUrl=baseUrl, basePath=basePath, manifest=manifest, errors=errors):
+            log(f"  {greenOk}")
+        else:
+            log(f"  {greenOk} (unchanged)")
+
+    saveManifest(manifest, changedList)
 
     return min(0, len(errors))
 
@@ -250,6 +572,63 @@ def startFromTerminal(exitAfterwards=True):
         dest='basePath',
         default=defaultBasePath,
         help='Output directory')
+    parser.add_argument(
+        '-jobs',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='Number of parsers that run at the same time')
+    parser.add_argument(
+        '-canteenjobs',
+        dest='canteenJobs',
+        type=int,
+        default=1,
+        help='Number of canteens per parser that are updated at the same time')
+    parser.add_argument(
+        '-hostlimit',
+        dest='maxPerHost',
+        type=int,
+        default=webclient.defaultMaxPerHost,
+        help='Maximum number of requests in flight to the same upstream host')
+    parser.add_argument(
+        '-changed',
+        dest='changedList',
+        default=None,
+        help='Write the paths of all changed files to this file, "-" for stdout')
+    parser.add_argument(
+        '-budget',
+        dest='budget',
+        type=float,
+        default=None,
+        help='Time budget in seconds. The most outdated files are updated first, '
+             'no new work is started after the budget is used up')
+    parser.add_argument(
+        '-deadline',
+        dest='canteenSeconds',
+        type=float,
+        default=defaultCanteenSeconds,
+        help='Seconds for all upstream requests of one canteen, slower requests fail with a timeout')
+    parser.add_argument(
+        '-report',
+        dest='reportFile',
+        default=None,
+        help='Write a JSON report with timings, requests and sizes per parser and canteen to this file')
+    parser.add_argument(
+        '-httpcache',
+        dest='httpCacheDirectory',
+        default=None,
+        help='Keep downloaded pages in this directory and only download them again if they changed')
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument(
+        '-record',
+        dest='recordDirectory',
+        default=None,
+        help='Store all upstream responses in this directory, see -replay')
+    cassette.add_argument(
+        '-replay',
+        dest='replayDirectory',
+        default=None,
+        help='Serve all upstream responses from a directory created with -record, without network access')
 
     args = parser.parse_args()
 
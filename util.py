@@ -6,6 +6,8 @@ import lxml
 from zoneinfo import ZoneInfo
 from pyopenmensa.feed import LazyBuilder
 
+import runreport
+
 __all__ = ['xml_escape', 'xmlRemoveInvalidChars', 'StyledLazyBuilder',
            'now_local', 'xml_str_param', 'meta_from_xsl', 'weekdays_map']
 
@@ -31,13 +33,14 @@ def xmlRemoveInvalidChars(s):
 
 class StyledLazyBuilder(LazyBuilder):
     def toXMLFeed(self, styles=defaultStyleSheets):
-        feed = self.toXML()
-        xml_header = '<?xml version="1.0" encoding="UTF-8"?>\n'
-        if styles:
-            for style in styles:
-                xml_header += '<?xml-stylesheet href="' + \
-                    xml_escape(style, True) + '" type="text/css"?>\n'
-        return xmlRemoveInvalidChars(xml_header + feed.toprettyxml(indent='  '))
+        with runreport.stage('serialise'):
+            feed = self.toXML()
+            xml_header = '<?xml version="1.0" encoding="UTF-8"?>\n'
+            if styles:
+                for style in styles:
+                    xml_header += '<?xml-stylesheet href="' + \
+                        xml_escape(style, True) + '" type="text/css"?>\n'
+            return xmlRemoveInvalidChars(xml_header + feed.toprettyxml(indent='  '))
 
 
 def now_local():
@@ -82,10 +85,12 @@ def meta_from_xsl(file_name, data):
     # Generate xml
     xslt_tree = lxml.etree.parse(file_name)
     xslt = lxml.etree.XSLT(xslt_tree)
-    return lxml.etree.tostring(xslt(lxml.etree.Element("foobar"), **data),
-                               pretty_print=True,
-                               xml_declaration=True,
-                               encoding="utf-8").decode("utf-8")
+    result = xslt(lxml.etree.Element("foobar"), **data)
+    with runreport.stage('serialise'):
+        return lxml.etree.tostring(result,
+                                   pretty_print=True,
+                                   xml_declaration=True,
+                                   encoding="utf-8").decode("utf-8")
 
 
 weekdays_map = [
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# Python 3
+import os
+import sys
+import time
+import random
+import hashlib
+import threading
+import contextlib
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import runreport
+import deadline
+import cache
+from httpcache import HttpCache, buildResponse, storedHeaders
+from cassette import Cassette, fromEnvironment
+from version import __version__, useragentname, useragentcomment
+
+__all__ = ['CircuitOpenError', 'setMaxPerHost', 'setCircuitBreaker', 'setCacheDirectory', 'setCassette',
+           'replaying', 'hostSlot', 'requestCache', 'userAgent', 'get', 'post', 'fetchAll', 'parsed']
+
+# Upper limit of concurrent requests to one upstream host
+defaultMaxPerHost = 4
+
+maxPerHost = defaultMaxPerHost
+hostSemaphores = {}
+hostSemaphoresLock = threading.Lock()
+
+# Retries of 5xx responses and reset connections, with jittered exponential backoff
+maxRetries = 2
+retryBackoffSeconds = 1.0
+retryStatusCodes = (500, 502, 503, 504)
+
+# A host is not contacted anymore after this many consecutive failed requests,
+# until resetSeconds have passed (None: for the rest of the process)
+failureThreshold = 3
+resetSeconds = 300
+circuitBreakers = {}
+circuitBreakersLock = threading.Lock()
+
+# One requests.Session per host, requests is only imported when the first request is sent
+sessions = {}
+sessionsLock = threading.Lock()
+
+# Responses of the current run, see requestCache()
+runCache = None
+runCacheLock = threading.Lock()
+
+# GET responses on disk that are revalidated across runs, see setCacheDirectory()
+httpCache = None
+# Parse results on disk, next to the HTTP cache. Keyed by the hash of the body,
+# so an unchanged page is not parsed again in the next run, see parsed()
+parsedStore = None
+parsedSeconds = 7 * 24 * 60 * 60
+
+# Recorded requests, see setCassette()
+activeCassette = fromEnvironment()
+
+# Seconds to wait for an answer if the caller does not set a timeout. Inside
+# deadline.within() the remaining time is used if it is shorter
+defaultTimeout = 120
+
+# Parsed bodies of responses, see parsed(). A parsed document takes several times
+# the memory of its body, a BeautifulSoup tree of a menu page 20 to 50 times, decoded JSON about 4 times
+maxParsedEntries = 64
+maxParsedBytes = 256 * 1024 * 1024
+parsedResults = cache.getLRU('parsed', maxParsedEntries, maxParsedBytes)
+# Source digests of the parser modules for the keys of parsedStore, {filename: (mtime, digest)}
+codeVersions = {}
+
+
+def setMaxPerHost(n):
+    """Set the maximum number of requests that may be in flight to the same host"""
+    global maxPerHost
+    with hostSemaphoresLock:
+        maxPerHost = max(1, int(n))
+        hostSemaphores.clear()
+    with sessionsLock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+
+
+def setCircuitBreaker(threshold, seconds):
+    """Open the circuit of a host after threshold consecutive failures for seconds (None: forever)"""
+    global failureThreshold, resetSeconds
+    with circuitBreakersLock:
+        failureThreshold = max(1, int(threshold))
+        resetSeconds = seconds
+        circuitBreakers.clear()
+
+
+def setCacheDirectory(directory):
+    """Keep GET responses in directory and revalidate them with conditional requests.
+    Persistent parse results are kept in its subdirectory 'parsed'. None disables the cache"""
+    global httpCache, parsedStore
+    httpCache = HttpCache(directory) if directory else None
+    parsedStore = None
+    if directory:
+        parsedStore = cache.Cache('parsed', parsedSeconds, cache.DiskBackend(os.path.join(directory, 'parsed')))
+
+
+def setCassette(mode, directory):
+    """Record all responses to directory (mode='record') or serve them from there without
+    sending any request (mode='replay'). mode=None sends requests normally"""
+    global activeCassette
+    activeCassette = Cassette(mode, directory) if mode else None
+
+
+def replaying():
+    """True if responses are served from a cassette"""
+    return bool(activeCassette and activeCassette.replaying)
+
+
+def _hostSemaphore(url):
+    host = urllib.parse.urlsplit(url).hostname or ''
+    with hostSemaphoresLock:
+        if host not in hostSemaphores:
+            hostSemaphores[host] = threading.BoundedSemaphore(maxPerHost)
+        return hostSemaphores[host]
+
+
+@contextlib.contextmanager
+def hostSlot(url):
+    """Wait until less than maxPerHost requests are running to the host of url"""
+    semaphore = _hostSemaphore(url)
+    if not semaphore.acquire(timeout=deadline.timeout()):
+        raise deadline.DeadlineExceeded(f"No time left to wait for a connection to {url}")
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+@contextlib.contextmanager
+def requestCache():
+    """Inside this context, each distinct request (method, url, body) is only sent once
+    and all callers share the response"""
+    global runCache
+    runCache = {}
+    try:
+        yield
+    finally:
+        runCache = None
+
+
+def _requestKey(method, url, body):
+    if isinstance(body, dict):
+        body = tuple(sorted(body.items()))
+    return method, url, body
+
+
+def _cached(key, fetch):
+    """Return the response for key from the run cache or call fetch().
+    Concurrent callers with the same key wait for the first one"""
+    cache = runCache
+    if cache is None:
+        return fetch()
+    with runCacheLock:
+        future = cache.get(key)
+        owner = future is None
+        if owner:
+            future = cache[key] = Future()
+    if owner:
+        try:
+            future.set_result(fetch())
+        except BaseException as e:
+            # Do not keep errors, a later call may try again
+            with runCacheLock:
+                cache.pop(key, None)
+            future.set_exception(e)
+            raise
+    return deadline.result(future)
+
+
+def _session(url):
+    """Keep-alive connection pool for the host of url, shared by all threads"""
+    import requests
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with sessionsLock:
+        session = sessions.get(key)
+        if session is None:
+            session = sessions[key] = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxPerHost)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = userAgent()
+        return session
+
+
+def userAgent():
+    """User-Agent header of all requests, unless the caller sets its own"""
+    import requests
+    return f'{useragentname}/{__version__} ({useragentcomment}) {requests.utils.default_user_agent()}'
+
+
+class CircuitOpenError(IOError):
+    """The host failed too often recently, the request was not sent"""
+
+
+class CircuitBreaker:
+    """Counts consecutive failures of one host"""
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.openedAt = None
+
+    def check(self):
+        """Raise CircuitOpenError if requests to the host should not be sent"""
+        with self.lock:
+            if self.openedAt is None:
+                return
+            if resetSeconds is not None and time.monotonic() - self.openedAt >= resetSeconds:
+                # Let requests through again, the next failure opens the circuit again
+                self.openedAt = None
+                self.failures = failureThreshold - 1
+                return
+            raise CircuitOpenError(f"{self.host} failed {self.failures} times in a row, not sending more requests")
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= failureThreshold and self.openedAt is None:
+                self.openedAt = time.monotonic()
+
+
+def _circuitBreaker(url):
+    host = urllib.parse.urlsplit(url).hostname or ''
+    with circuitBreakersLock:
+        if host not in circuitBreakers:
+            circuitBreakers[host] = CircuitBreaker(host)
+        return circuitBreakers[host]
+
+
+def _backoff(attempt):
+    """Random wait before retry number attempt (1, 2, ...)"""
+    return random.uniform(0, retryBackoffSeconds * 2 ** (attempt - 1))  # nosec
+
+
+def _timeLeftFor(seconds):
+    remaining = deadline.remaining()
+    return remaining is None or seconds < remaining
+
+
+def _send(method, url, timeout=None, **kwargs):
+    """Send a request over the pooled session of the host. Transient errors are retried,
+    hosts that keep failing are skipped with CircuitOpenError. The timeout is shortened
+    to the time that is left until the current deadline"""
+    import requests
+    breaker = _circuitBreaker(url)
+    breaker.check()
+    requested = defaultTimeout if timeout is None else timeout
+    attempt = 0
+    while True:
+        limit = deadline.timeout(requested)
+        wait = _backoff(attempt + 1)
+        try:
+            with hostSlot(url):
+                response = _session(url).request(method, url, timeout=limit, **kwargs)
+        except requests.exceptions.Timeout as e:
+            if limit < requested:
+                # Not the fault of the host, the caller ran out of time
+                raise deadline.DeadlineExceeded(f"{url} did not answer within the remaining {limit:.1f}s") from e
+            # Timeouts are not transient enough to wait for them again
+            breaker.failure()
+            raise
+        except requests.exceptions.ConnectionError as e:
+            # Certificate errors are not transient either
+            transient = not isinstance(e, requests.exceptions.SSLError)
+            if not transient or attempt >= maxRetries or not _timeLeftFor(wait):
+                if transient:
+                    breaker.failure()
+                raise
+        else:
+            if response.status_code not in retryStatusCodes or attempt >= maxRetries or not _timeLeftFor(wait):
+                break
+        attempt += 1
+        time.sleep(wait)
+
+    if response.status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+    # requests asks for compressed bodies by default and decodes them, raw.tell() is the size on the wire
+    runreport.addRequest(len(response.content), response.raw.tell() if response.raw else None)
+    return response
+
+
+def _get(url, **kwargs):
+    cache = httpCache
+    entry = cache.load(url) if cache else None
+    if entry:
+        kwargs['headers'] = {**(kwargs.get('headers') or {}), **cache.validators(entry)}
+    response = _send('GET', url, **kwargs)
+    if entry and response.status_code == 304:
+        cached = cache.response(entry, response)
+        if cache.validators(entry) != cache.validators({'headers': cached.headers}):
+            cache.store(url, cached)
+        return cached
+    if cache:
+        cache.store(url, response)
+    return response
+
+
+def _post(url, **kwargs):
+    response = _send('POST', url, **kwargs)
+    return response
+
+
+def _recorded(key, send):
+    """Serve the response from the cassette or call send() and record the response"""
+    cassette = activeCassette
+    if cassette is None:
+        return send()
+    if cassette.replaying:
+        response = cassette.replay(key)
+        runreport.addRequest(len(response.content))
+        return response
+    response = send()
+    cassette.record(key, response)
+    return response
+
+
+def _stored(key, maxAge, send):
+    """Serve the response from the 'responses' cache if it is younger than maxAge seconds,
+    otherwise call send() and store the response. Inside _recorded(), so responses from
+    the cache are recorded too"""
+    if not maxAge:
+        return send()
+    responses = cache.getCache('responses')
+    entry = responses.getWithAge(repr(key), maxAge)
+    if entry is not None:
+        response = buildResponse(*entry[0])
+        return response
+    response = send()
+    if response.status_code < 500:
+        responses.set(repr(key), (response.url, response.status_code, storedHeaders(response),
+                                  response.encoding, response.content), ttl=maxAge)
+    return response
+
+
+def get(url, maxAge=None, **kwargs):
+    """requests.get() over a pooled connection with a limit on concurrent requests per host.
+    With maxAge, a response that is at most maxAge seconds old is taken from the cache"""
+    key = _requestKey('GET', url, kwargs.get('data'))
+    with runreport.stage('fetch'):
+        return _cached(key, lambda: _recorded(key, lambda: _stored(key, maxAge, lambda: _get(url, **kwargs))))
+
+
+def post(url, maxAge=None, **kwargs):
+    """requests.post() over a pooled connection with a limit on concurrent requests per host.
+    With maxAge, a response that is at most maxAge seconds old is taken from the cache"""
+    key = _requestKey('POST', url, kwargs.get('data'))
+    with runreport.stage('fetch'):
+        return _cached(key, lambda: _recorded(key, lambda: _stored(key, maxAge, lambda: _post(url, **kwargs))))
+
+
+def fetchAll(requestList, maxWorkers=32):
+    """Send a batch of requests at the same time and wait until all of them are done.
+    requestList contains (method, url, kwargs) tuples, the responses are returned in the
+    same order and a failed request is returned as its exception. The requests go through
+    get() and post(), so inside requestCache() the same calls later return immediately"""
+    import asyncio
+    if not requestList:
+        return []
+    calls = {'GET': get, 'POST': post}
+
+    async def fetchBatch():
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=min(maxWorkers, len(requestList))))
+        # asyncio.to_thread() copies the context, so the requests are counted in the current run report record
+        return await asyncio.gather(*[asyncio.to_thread(calls[method], url, **kwargs)
+                                      for method, url, kwargs in requestList], return_exceptions=True)
+
+    # The requests overlap, so the wall time of the whole batch is the fetch time
+    with runreport.stage('fetch'):
+        return asyncio.run(fetchBatch())
+
+
+def _codeVersion(parse):
+    """Digest of the source file of the module of parse, so that results on disk
+    are not used after the parser was changed"""
+    filename = getattr(sys.modules.get(parse.__module__), '__file__', None)
+    if not filename:
+        return hashlib.sha256(parse.__code__.co_code).hexdigest()
+    modified = os.stat(filename).st_mtime_ns
+    known = codeVersions.get(filename)
+    if known is None or known[0] != modified:
+        with open(filename, 'rb') as f:
+            known = codeVersions[filename] = (modified, hashlib.sha256(f.read()).hexdigest())
+    return known[1]
+
+
+def parsed(response, parse, sizeFactor=40, persistent=False):
+    """Return parse(response), or the earlier result if the same body of the same url was
+    already parsed with this function. The result is shared and must not be modified.
+    Results are kept while their estimated size, sizeFactor times the size of the body,
+    fits into maxParsedBytes. With persistent=True the result must be picklable and is
+    also kept on disk across runs, if there is a cache directory"""
+    key = (response.url, parse.__module__, parse.__qualname__)
+    digest = hashlib.sha256(response.content).digest()
+    known = parsedResults.get(key)
+    if known and known[0] == digest:
+        return known[1]
+    store = parsedStore if persistent else None
+    storeKey = f'{key!r} {digest.hex()} {_codeVersion(parse)}' if store else None
+    result = store.get(storeKey) if store else None
+    if result is None:
+        result = parse(response)
+        if store:
+            store.set(storeKey, result)
+    parsedResults.set(key, (digest, result), size=len(response.content) * sizeFactor)
+    return result